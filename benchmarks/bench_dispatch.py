@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018-2020 Václav Slavík
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Measures lines/sec of JablotronRS485.line_received dispatch, compared with
+the linear regex scan it replaced.
+
+Run from the source tree as `pipenv run python benchmarks/bench_dispatch.py`.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import jablotron.core
+
+CONFIG = os.path.join(os.path.dirname(__file__), '..', 'jablotron.example.toml')
+
+# Typical traffic of a busy panel: mostly PRFSTATE pushes and section states.
+TRACE = [
+    'PRFSTATE 00000000000000000000000000000000',
+    'PRFSTATE 40020000000000000000000000000000',
+    'STATE 1 READY',
+    'PRFSTATE 40000000000000000000000000000000',
+    'STATE 2 ARMED',
+    'ENTRY 1 ON',
+    'ENTRY 1 OFF',
+    'OK',
+    'PRFSTATE 00000000000000000000000000000000',
+    'JA-121T, SN:1210037d, SWV:NN60202, HWV:1',
+]
+
+
+class LinearScanProtocol(jablotron.core.JablotronRS485):
+    """Dispatch through every handler's regex in turn, as the bridge used to."""
+    def __init__(self, loop, config_file):
+        super().__init__(loop, config_file)
+        self._linear_map = {}
+        for fn in (getattr(self, x) for x in dir(self)):
+            if callable(fn):
+                regex = getattr(fn, '_regex', None)
+                if regex:
+                    self._linear_map[re.compile('^{}$'.format(regex))] = fn
+
+    def line_received(self, line):
+        jablotron.core.logger.info(' ← %s', repr(line))
+        if not line:
+            return
+        for regex, fn in self._linear_map.items():
+            m = regex.match(line)
+            if m:
+                fn(*m.groups())
+                self.commands.reply_received(fn.__name__)
+                return
+
+
+def stub_handlers(protocol):
+    """Replace handlers with no-ops to measure the cost of dispatch alone."""
+    def noop(*args):
+        pass
+    if isinstance(protocol, LinearScanProtocol):
+        protocol._linear_map = {regex: noop for regex in protocol._linear_map}
+    else:
+        protocol._responses_map = {t: (regex, noop) for t, (regex, _) in protocol._responses_map.items()}
+        protocol._fallback_responses = [(regex, noop) for regex, _ in protocol._fallback_responses]
+
+
+def measure(protocol, repeat):
+    lines = TRACE * repeat
+    start = time.perf_counter()
+    for line in lines:
+        protocol.line_received(line)
+    return len(lines) / (time.perf_counter() - start)
+
+
+def main():
+    logging.disable(logging.WARNING)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    repeat = 20000
+
+    for name, cls in (('linear scan', LinearScanProtocol), ('prefix dispatch', jablotron.core.JablotronRS485)):
+        for stubbed in (False, True):
+            protocol = cls(loop, CONFIG)
+            if stubbed:
+                stub_handlers(protocol)
+            best = max(measure(protocol, repeat) for _ in range(3))
+            print('{:16} {:14} {:10.0f} lines/sec'.format(name, 'dispatch only' if stubbed else 'with handlers', best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018-2020 Václav Slavík
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+End-to-end benchmark of the bridge against the JA-121T emulator: measures
+latency from a line written to the serial link to the HomeKit characteristic
+changing, and the maximum rate of sensor events the bridge keeps up with.
+
+Run from the source tree as `pipenv run python benchmarks/bench_e2e.py`.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+from pyhap.characteristic import Characteristic
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import jablotron.core
+import jablotron.homekit
+from jablotron.emulator import Emulator
+
+PIN = '4*1234'
+SECTIONS = [1, 2]
+
+
+def write_config(path, port, sensors):
+    with open(path, 'w') as f:
+        f.write('pin = "{}"\n'.format(PIN))
+        f.write('sensors = [\n')
+        for sid in range(1, sensors + 1):
+            kind = 'motion' if sid % 2 else 'window'
+            f.write('  {{ id = {}, kind = "{}", name = "Sensor {}" }},\n'.format(sid, kind, sid))
+        f.write(']\n')
+        f.write('states = [\n')
+        f.write('  { name = "home", partial = [1] },\n')
+        f.write('  { name = "away", armed = [1, 2] },\n')
+        f.write(']\n')
+        f.write('[serial]\nport = "{}"\n'.format(port))
+        f.write('[homekit]\nport = 0\n')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(name, latencies):
+    print('{:28} p50 {:8.2f} ms   p99 {:8.2f} ms   ({} samples)'.format(
+          name, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, len(latencies)))
+
+
+class Probe:
+    """Records when HomeKit characteristics change."""
+    def __init__(self):
+        self.watched = {}
+        self.waiting = {}
+        self.latencies = []
+        self.updates = 0
+        original = Characteristic.set_value
+        probe = self
+
+        def set_value(char, value, *args, **kwargs):
+            original(char, value, *args, **kwargs)
+            key = probe.watched.get(id(char))
+            if key is not None:
+                probe.updates += 1
+                sent = probe.waiting.pop((key, value), None)
+                if sent is not None:
+                    probe.latencies.append(time.perf_counter() - sent)
+        Characteristic.set_value = set_value
+
+    def watch(self, char, key):
+        self.watched[id(char)] = key
+
+    def expect(self, key, value):
+        self.waiting[(key, value)] = time.perf_counter()
+
+
+async def wait_for(condition, timeout=10):
+    end = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > end:
+            raise asyncio.TimeoutError()
+        await asyncio.sleep(0.0005)
+
+
+async def run(args):
+    loop = asyncio.get_event_loop()
+    emulator = Emulator(loop, pin=PIN, sections=SECTIONS, peripherals=args.sensors + 1)
+    config = os.path.join(os.getcwd(), 'jablotron.toml')
+    write_config(config, emulator.port, args.sensors)
+
+    start = time.perf_counter()
+    alarm = await jablotron.core.create_connection(loop, config)
+    print('handshake took {:.1f} ms'.format((time.perf_counter() - start) * 1000))
+    driver = jablotron.homekit.create_driver(loop, alarm)
+
+    probe = Probe()
+    for sensor in alarm.sensors.values():
+        probe.watch(sensor.homekit.char, sensor.id)
+    probe.watch(alarm.homekit.char_current_state, 'alarm')
+
+    # sensor latency at a moderate rate
+    for _ in range(args.events):
+        sid = random.randint(1, args.sensors)
+        active = not alarm.sensors[sid].value
+        probe.expect(sid, active)
+        emulator.set_peripheral(sid, active)
+        await asyncio.sleep(1 / args.rate)
+    await wait_for(lambda: not any(k != 'alarm' for k, _ in probe.waiting))
+    report('sensor event -> HomeKit', probe.latencies)
+
+    # alarm state changes driven by the panel
+    probe.latencies = []
+    states = {'READY': 3, 'ARMED_PART': 0}
+    for i in range(args.state_changes):
+        state = 'ARMED_PART' if i % 2 == 0 else 'READY'
+        probe.expect('alarm', states[state])
+        emulator.set_section(1, state)
+        await wait_for(lambda: ('alarm', states[state]) not in probe.waiting)
+    report('section state -> HomeKit', probe.latencies)
+
+    # sustained throughput: flood sensor toggles and wait until the last one is processed
+    events = args.flood
+    start = time.perf_counter()
+    for _ in range(events):
+        sid = random.randint(1, args.sensors)
+        emulator.set_peripheral(sid, not emulator.peripherals & (1 << sid))
+        if emulator.pending_output > 65536:
+            await wait_for(lambda: emulator.pending_output < 16384)
+    last = emulator.prfstate().split()[1]
+    await wait_for(lambda: alarm._prfstate == last, timeout=60)
+    elapsed = time.perf_counter() - start
+    print('{:28} {:8.0f} events/sec   ({} HomeKit updates)'.format('sustained throughput', events / elapsed,
+                                                                     probe.updates))
+
+    emulator.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end latency and throughput benchmark.')
+    parser.add_argument('--sensors', type=int, default=64, help='number of configured sensors')
+    parser.add_argument('--events', type=int, default=500, help='sensor events for latency measurement')
+    parser.add_argument('--rate', type=float, default=100, help='events/sec for latency measurement')
+    parser.add_argument('--state-changes', type=int, default=20, help='section state changes to measure')
+    parser.add_argument('--flood', type=int, default=20000, help='sensor events for throughput measurement')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # HAP-python persists its state to the working directory
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        loop.run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018-2020 Václav Slavík
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+"""
+Per-line cost of logging serial traffic under a flood of PRFSTATE reports:
+synchronous logging of every line (as the bridge used to do), every line
+through the logging queue, the default rate-limited wire log, and the wire
+log turned off. The log file is synced after every record by default, like
+a log on an SD card or a slow syslog; with --no-fsync it's left to the page
+cache, where writing costs little either way.
+
+Run from the source tree as `pipenv run python benchmarks/bench_logging.py`.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import jablotron.core
+import jablotron.logs
+
+
+def make_alarm(loop, sensors, rate):
+    config = {
+        'id': None,
+        'pin': '4*1234',
+        'sensors': [{'id': sid, 'kind': 'motion'} for sid in range(1, sensors + 1)],
+        'states': [{'name': 'away', 'armed': [1]}],
+        'logging': {'wire_rate': rate},
+    }
+    return jablotron.core.JablotronRS485(loop, config)
+
+
+def make_flood(lines, sensors):
+    bits = 0
+    data = []
+    for _ in range(lines):
+        bits ^= 1 << random.randint(1, sensors)
+        data.append('PRFSTATE {}\r\n'.format(bits.to_bytes((sensors + 8) // 8, 'little').hex().upper()).encode())
+    return data
+
+
+class SyncingFileHandler(logging.FileHandler):
+    """Writes every record through to the disk."""
+    def emit(self, record):
+        super().emit(record)
+        self.flush()
+        os.fsync(self.stream.fileno())
+
+
+def measure(args, mode, log_file):
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(logging.INFO)
+    # the bridge's own messages (sensor activated etc.) are logged in all modes
+    root.addHandler(SyncingFileHandler(log_file) if args.fsync else logging.FileHandler(log_file))
+    logging.getLogger(jablotron.logs.WIRE_LOGGER).setLevel(logging.WARNING if mode == 'off' else logging.INFO)
+    listener = jablotron.logs.start_queue_logging() if mode != 'sync' else None
+
+    loop = asyncio.new_event_loop()
+    alarm = make_alarm(loop, args.sensors, jablotron.logs.DEFAULT_WIRE_RATE if mode == 'limited' else 0)
+    flood = make_flood(args.lines, args.sensors)
+    start = time.perf_counter()
+    for data in flood:
+        alarm.data_received(data)
+    elapsed = time.perf_counter() - start
+    if listener is not None:
+        listener.stop()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    loop.close()
+    print('{:10} {:8.2f} µs/line'.format(mode, elapsed / args.lines * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Logging overhead benchmark.')
+    parser.add_argument('--lines', type=int, default=50000, help='PRFSTATE lines in the flood')
+    parser.add_argument('--sensors', type=int, default=64, help='number of configured sensors')
+    parser.add_argument('--no-fsync', dest='fsync', action='store_false', help="don't sync the log after every record")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ('sync', 'queue', 'limited', 'off'):
+            measure(args, mode, os.path.join(tmp, mode + '.log'))
+
+
+if __name__ == '__main__':
+    main()
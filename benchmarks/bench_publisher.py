@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018-2020 Václav Slavík
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Fan-out of sensor events to MQTT under bursts of PRFSTATE reports, against
+a local stand-in of an MQTT broker that can be fast, slow to read or down.
+Reports time spent handling the serial data with and without the publisher,
+messages delivered to the broker, and the subscription's queue depth and
+losses; then the throughput of delivering a large backlog.
+
+Run from the source tree as `pipenv run python benchmarks/bench_publisher.py`.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import jablotron.core
+import jablotron.mqtt
+import jablotron.publisher
+
+
+class Broker:
+    """Accepts MQTT connections and counts PUBLISH packets; reads only every read_delay seconds if set."""
+    def __init__(self, read_delay=0):
+        self.read_delay = read_delay
+        self.published = 0
+        self.last_published_at = None
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    def close(self):
+        self._server.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            packet_type, _ = await jablotron.mqtt.read_packet(reader)
+            assert packet_type == jablotron.mqtt.CONNECT
+            writer.write(jablotron.mqtt.packet(jablotron.mqtt.CONNACK, b'\0\0'))
+            while True:
+                if self.read_delay:
+                    await asyncio.sleep(self.read_delay)
+                packet_type, _ = await jablotron.mqtt.read_packet(reader)
+                if packet_type & 0xF0 == jablotron.mqtt.PUBLISH:
+                    self.published += 1
+                    self.last_published_at = time.perf_counter()
+                elif packet_type == jablotron.mqtt.PINGREQ:
+                    writer.write(jablotron.mqtt.packet(jablotron.mqtt.PINGRESP))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+
+
+def make_alarm(loop, sensors):
+    config = {
+        'id': None,
+        'pin': '4*1234',
+        'sensors': [{'id': sid, 'kind': 'motion'} for sid in range(1, sensors + 1)],
+        'states': [{'name': 'away', 'armed': [1]}],
+        'logging': {'wire_rate': 0},
+    }
+    return jablotron.core.JablotronRS485(loop, config)
+
+
+def make_bursts(args):
+    bits = 0
+    bursts = []
+    for _ in range(args.bursts):
+        burst = []
+        for _ in range(args.burst_size):
+            bits ^= 1 << random.randint(1, args.sensors)
+            burst.append('PRFSTATE {}\r\n'.format(bits.to_bytes((args.sensors + 8) // 8, 'little').hex().upper()).encode())
+        bursts.append(burst)
+    return bursts
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def run(args, broker_mode, bursts):
+    loop = asyncio.get_event_loop()
+    alarm = make_alarm(loop, args.sensors)
+    broker = client = None
+    if broker_mode != 'none':
+        publisher = jablotron.publisher.Publisher(loop)
+        publisher.add_alarm(alarm)
+        subscription = publisher.subscribe(broker_mode, args.queue_size, args.overflow)
+        broker = Broker(read_delay=0.01 if broker_mode == 'slow' else 0)
+        port = await broker.start()
+        if broker_mode == 'down':
+            broker.close()
+        client = jablotron.mqtt.MQTTClient(loop, subscription, '127.0.0.1', port, keepalive=0,
+                                           reconnect_max_delay=1)
+        client.start()
+        await asyncio.sleep(0.1)
+        published_before = broker.published
+
+    max_depth = 0
+    per_line = []
+    started = time.perf_counter()
+    for burst in bursts:
+        start = time.perf_counter()
+        for data in burst:
+            alarm.data_received(data)
+        per_line.append((time.perf_counter() - start) / len(burst))
+        if client is not None:
+            max_depth = max(max_depth, len(subscription))
+        await asyncio.sleep(args.burst_interval)
+
+    line = '{:8} p50 {:6.2f} µs/line  p99 {:6.2f} µs/line'.format(
+        broker_mode, percentile(per_line, 50) * 1e6, percentile(per_line, 99) * 1e6)
+    if client is not None:
+        # let the queue drain
+        for _ in range(100):
+            if not len(subscription):
+                break
+            await asyncio.sleep(0.05)
+        delivered = broker.published - published_before
+        elapsed = (broker.last_published_at or started) - started
+        dropped = jablotron.publisher.DROPPED
+        line += '  {:7} delivered ({:8.0f}/s)  max queue {:5}  dropped {:6} coalesced {:6}'.format(
+            delivered, delivered / elapsed if delivered else 0, max_depth,
+            dropped.labels(broker_mode, 'overflow').value, dropped.labels(broker_mode, 'coalesced').value)
+        client.stop()
+        broker.close()
+    print(line)
+
+
+async def run_throughput(args):
+    """Deliver a backlog of messages to a fast broker as quickly as possible."""
+    loop = asyncio.get_event_loop()
+    publisher = jablotron.publisher.Publisher(loop)
+    subscription = publisher.subscribe('throughput', args.messages, jablotron.publisher.DROP_OLDEST)
+    broker = Broker()
+    port = await broker.start()
+    client = jablotron.mqtt.MQTTClient(loop, subscription, '127.0.0.1', port, keepalive=0)
+    client.start()
+    while not client.connected:
+        await asyncio.sleep(0.01)
+    started = time.perf_counter()
+    for i in range(args.messages):
+        publisher.publish('jablotron/sensor/{}'.format(i % 1000), 'ON' if i % 2 else 'OFF')
+    while broker.published < args.messages:
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - started
+    batches = jablotron.publisher.BATCH_SIZE.labels('throughput')
+    print('throughput {:8.0f} messages/s, {:.0f} messages per batch on average'.format(
+          args.messages / elapsed, batches.sum / sum(batches.counts)))
+    client.stop()
+    broker.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MQTT publisher benchmark.')
+    parser.add_argument('--sensors', type=int, default=64, help='number of configured sensors')
+    parser.add_argument('--bursts', type=int, default=200, help='bursts of PRFSTATE lines')
+    parser.add_argument('--burst-size', type=int, default=50, help='PRFSTATE lines in a burst')
+    parser.add_argument('--burst-interval', type=float, default=0.01, help='seconds between bursts')
+    parser.add_argument('--messages', type=int, default=100000, help='messages for the throughput test')
+    parser.add_argument('--queue-size', type=int, default=jablotron.publisher.DEFAULT_QUEUE_SIZE)
+    parser.add_argument('--overflow', choices=[jablotron.publisher.COALESCE, jablotron.publisher.DROP_OLDEST],
+                        default=jablotron.publisher.COALESCE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    random.seed(1)
+    bursts = make_bursts(args)
+    for broker_mode in ('none', 'fast', 'slow', 'down'):
+        loop.run_until_complete(run(args, broker_mode, bursts))
+    loop.run_until_complete(run_throughput(args))
+
+
+if __name__ == '__main__':
+    main()
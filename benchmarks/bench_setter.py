@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018-2020 Václav Slavík
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+"""
+Latency from a HomeKit setter callback to the arming command being written
+to the serial link, with the setter running on the event loop ("loop", as
+with HAP-python 3+) and, for comparison, on a HAP server thread handing the
+request over with run_coroutine_threadsafe() ("thread", as the bridge did
+with HAP-python 2).
+
+Run from the source tree as `pipenv run python benchmarks/bench_setter.py`.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import jablotron.core
+import jablotron.homekit
+from jablotron.emulator import Emulator
+from bench_e2e import PIN, report, wait_for, write_config
+
+
+class Recorder:
+    """Records time from the setter being called to the command being written."""
+    def __init__(self, alarm):
+        self.latencies = []
+        self.called_at = None
+        original = alarm.commands.write
+
+        def write(text):
+            if self.called_at is not None:
+                self.latencies.append(time.perf_counter() - self.called_at)
+                self.called_at = None
+            original(text)
+        alarm.commands.write = write
+
+
+def hap_server_thread(loop, requests, alarm, recorder):
+    """Stand-in for the HAP server thread of HAP-python 2."""
+    async def set_alarm_state(state):
+        alarm.set_alarm_state(state)
+
+    while True:
+        state = requests.get()
+        if state is None:
+            return
+        recorder.called_at = time.perf_counter()
+        asyncio.run_coroutine_threadsafe(set_alarm_state(state), loop)
+
+
+async def run(args):
+    loop = asyncio.get_event_loop()
+    emulator = Emulator(loop, pin=PIN, sections=[1, 2])
+    config = os.path.join(os.getcwd(), 'jablotron.toml')
+    write_config(config, emulator.port, 0)
+    alarm = await jablotron.core.create_connection(loop, config)
+    driver = jablotron.homekit.create_driver(loop, alarm)
+    accessory = driver.accessory
+    char = accessory.char_target_state
+    recorder = Recorder(alarm)
+
+    if args.mode == 'thread':
+        import queue
+        requests = queue.Queue()
+        thread = threading.Thread(target=hap_server_thread, args=(loop, requests, alarm, recorder))
+        thread.start()
+
+    # alternate between away (1) and disarmed (3)
+    for i in range(args.changes):
+        hk_state = 1 if i % 2 == 0 else 3
+        core_state = jablotron.core.STATE_AWAY if hk_state == 1 else jablotron.core.STATE_DISARMED
+        if args.mode == 'thread':
+            requests.put(core_state)
+        else:
+            # what the HAP server does with a write request from a controller
+            recorder.called_at = time.perf_counter()
+            char.client_update_value(hk_state)
+        await wait_for(lambda: alarm.current_state == core_state)
+        await asyncio.sleep(0.002)
+
+    if args.mode == 'thread':
+        requests.put(None)
+        thread.join()
+    report('setter -> written ({})'.format(args.mode), recorder.latencies)
+    emulator.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HomeKit setter to serial write latency benchmark.')
+    parser.add_argument('--mode', choices=['loop', 'thread'], default='loop',
+                        help='call setters on the event loop or on a separate thread')
+    parser.add_argument('--changes', type=int, default=200, help='alarm state changes to measure')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # HAP-python persists its state to the working directory
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        loop.run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
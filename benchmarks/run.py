@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018-2020 Václav Slavík
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+"""
+Microbenchmarks of the protocol's hot paths, checked against a stored
+baseline:
+
+    pipenv run python benchmarks/run.py                # compare with baseline.json
+    pipenv run python benchmarks/run.py --save         # record new baseline
+    pipenv run python benchmarks/run.py -k prfstate    # only matching benchmarks
+
+Each benchmark reports operations per second (best of several runs) and
+memory allocated per operation: peak bytes allocated above the starting
+point while running, and blocks still allocated afterwards, as measured by
+tracemalloc. The exit status is 1 if any benchmark is slower, or allocates
+more, than the baseline by more than --threshold.
+
+Speed is compared as the median of its ratios to a reference workload timed
+right before each run, which cancels out most of the difference between
+machines and of the noise between runs; an apparent regression is measured
+again and only reported if the median of the measurements confirms it. Baselines still depend
+on the Python version; save one before making changes and compare after.
+
+Inputs are wire traces in the emulator's replay format (see
+jablotron.emulator.Emulator.replay): recorded ones from traces/ and
+synthetic ones generated here.
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import jablotron.core
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+TRACES = os.path.join(os.path.dirname(__file__), 'traces')
+DEFAULT_THRESHOLD = 0.3
+# measurements of a benchmark that seems slower than the baseline, or
+# that's being saved as one
+CONFIRM_RUNS = 3
+# calls of a benchmark measuring its memory, the least is reported
+MEMORY_RUNS = 3
+
+
+def load_trace(path):
+    """Return lines of a trace in the emulator's replay format, ignoring delays."""
+    lines = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                lines.append(line.split(None, 1)[1])
+    return lines
+
+
+def prfstate_line(bits, peripherals):
+    return 'PRFSTATE {}'.format(bits.to_bytes((peripherals + 7) // 8, 'little').hex().upper())
+
+
+def synthetic_trace(count, peripherals=64, sections=2, seed=1):
+    """
+    Traffic of a busy panel: mostly repeated PRFSTATE reports with occasional
+    sensor changes, section states and flags.
+    """
+    rnd = random.Random(seed)
+    bits = 0
+    lines = []
+    while len(lines) < count:
+        r = rnd.random()
+        if r < 0.2:
+            bits ^= 1 << rnd.randrange(1, peripherals)
+            lines.append(prfstate_line(bits, peripherals))
+        elif r < 0.85:
+            lines.append(prfstate_line(bits, peripherals))
+        elif r < 0.95:
+            lines.append('STATE {} {}'.format(rnd.randint(1, sections), rnd.choice(['READY', 'ARMED', 'ARMED_PART'])))
+        else:
+            lines.append('{} {} {}'.format(rnd.choice(['ENTRY', 'EXIT']), rnd.randint(1, sections),
+                                           rnd.choice(['ON', 'OFF'])))
+    return lines
+
+
+def make_alarm(loop, sensors=64, sections=2, states=None):
+    config = {
+        'id': None,
+        'pin': '4*1234',
+        'sensors': [{'id': sid, 'kind': 'motion'} for sid in range(1, sensors + 1)],
+        'states': states if states is not None else _many_states(sections),
+        'logging': {'wire_rate': 0},
+    }
+    return jablotron.core.JablotronRS485(loop, config)
+
+
+def to_chunks(lines, size=64):
+    """Wire bytes of lines split into reads of size bytes, as they come from the port."""
+    data = b''.join(line.encode() + b'\r\n' for line in lines)
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+# Each benchmark is a function taking the event loop and returning
+# (operation, number of ops it performs per call).
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def decorator(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return decorator
+
+
+def _trace_lines():
+    recorded = []
+    if os.path.isdir(TRACES):
+        for name in sorted(os.listdir(TRACES)):
+            if name.endswith('.trace'):
+                recorded += load_trace(os.path.join(TRACES, name))
+    return recorded
+
+
+@benchmark('data_received/synthetic')
+def bench_data_received_synthetic(loop):
+    alarm = make_alarm(loop)
+    lines = synthetic_trace(2000)
+    chunks = to_chunks(lines)
+
+    def run():
+        for chunk in chunks:
+            alarm.data_received(chunk)
+    return run, len(lines)
+
+
+@benchmark('data_received/recorded')
+def bench_data_received_recorded(loop):
+    alarm = make_alarm(loop)
+    lines = _trace_lines()
+    chunks = to_chunks(lines)
+
+    def run():
+        for chunk in chunks:
+            alarm.data_received(chunk)
+    return run, len(lines)
+
+
+@benchmark('line_received/synthetic')
+def bench_line_received(loop):
+    alarm = make_alarm(loop)
+    lines = synthetic_trace(2000)
+
+    def run():
+        for line in lines:
+            alarm.line_received(line)
+    return run, len(lines)
+
+
+def _bench_prfstate(loop, peripherals):
+    alarm = make_alarm(loop, sensors=peripherals - 1)
+    rnd = random.Random(peripherals)
+    bits = 0
+    reports = []
+    for _ in range(1000):
+        bits ^= 1 << rnd.randrange(1, peripherals)
+        reports.append(prfstate_line(bits, peripherals).split()[1])
+
+    def run():
+        for hex_state in reports:
+            alarm.on_prfstate(hex_state)
+    return run, len(reports)
+
+
+@benchmark('on_prfstate/8')
+def bench_prfstate_8(loop):
+    return _bench_prfstate(loop, 8)
+
+
+@benchmark('on_prfstate/64')
+def bench_prfstate_64(loop):
+    return _bench_prfstate(loop, 64)
+
+
+@benchmark('on_prfstate/230')
+def bench_prfstate_230(loop):
+    return _bench_prfstate(loop, 230)
+
+
+def _many_states(sections):
+    """A state for each combination of sections armed, partially armed or not."""
+    states = []
+    for n in range(1, 3 ** sections):
+        armed, partial = [], []
+        for s in range(1, sections + 1):
+            n, digit = divmod(n, 3)
+            if digit == 1:
+                armed.append(s)
+            elif digit == 2:
+                partial.append(s)
+        states.append({'name': 'state{}'.format(len(states)), 'armed': armed, 'partial': partial})
+    return states
+
+
+@benchmark('state_resolution/729_states')
+def bench_state_resolution(loop):
+    sections = 6
+    alarm = make_alarm(loop, sections=sections, states=_many_states(sections))
+    rnd = random.Random(2)
+    reports = [{s: rnd.choice(['READY', 'ARMED', 'ARMED_PART']) for s in range(1, sections + 1)} for _ in range(500)]
+
+    def run():
+        for sections in reports:
+            alarm.section_states.update(sections)
+            alarm._process_state_change()
+    return run, len(reports)
+
+
+@benchmark('AlarmState.matches/729_states')
+def bench_state_matches(loop):
+    sections = 6
+    alarm = make_alarm(loop, sections=sections, states=_many_states(sections))
+    states = list(alarm.states.values())
+    rnd = random.Random(3)
+    reports = [{s: rnd.choice(['READY', 'ARMED', 'ARMED_PART']) for s in range(1, sections + 1)} for _ in range(20)]
+
+    def run():
+        for sections in reports:
+            for st in states:
+                if st.matches(sections):
+                    break
+    return run, len(reports)
+
+
+@benchmark('Alarm.update/16_buttons')
+def bench_alarm_update(loop):
+    import jablotron.homekit
+    alarm = make_alarm(loop, sensors=0, states=[{'name': 'home', 'partial': [1]}, {'name': 'away', 'armed': [1, 2]}])
+    alarm.config['homekit'] = {'port': 0, 'fake_buttons': ['button{}'.format(i) for i in range(14)] + ['home', 'away']}
+    driver = jablotron.homekit.create_driver(loop, alarm)
+    accessory = alarm.homekit
+    states = ['home', 'away', 'disarmed', 'button3'] * 50
+
+    async def updates():
+        for state in states:
+            accessory.update(state)
+            # let the notifier flush, as it does after each iteration of the loop
+            await asyncio.sleep(0)
+
+    def run():
+        loop.run_until_complete(updates())
+    run.driver = driver
+    return run, len(states)
+
+
+def reference_workload():
+    """
+    Plain Python work unrelated to the bridge's code, similar to what the hot
+    paths do; benchmarks are compared by their speed relative to it.
+    """
+    lines = ['PRFSTATE {:016X}'.format(i * 2654435761 % (1 << 64)) for i in range(1000)]
+
+    def run():
+        counts = {}
+        for line in lines:
+            keyword, value = line.split(' ', 1)
+            counts[keyword] = counts.get(keyword, 0) + bin(int(value, 16)).count('1')
+    return run, len(lines)
+
+
+def _run_calls(fn, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return time.perf_counter() - start
+
+
+def _calibrate(fn, min_time):
+    """Return how many calls of fn take at least min_time."""
+    fn()  # warm up
+    calls = 1
+    while _run_calls(fn, calls) < min_time:
+        calls *= 2
+    return calls
+
+
+def measure(fn, ops, min_time, repeat, reference):
+    """
+    Return best ops/sec, median speed relative to (fn, ops) reference timed
+    right before each measurement, peak bytes per op and blocks left per op.
+    """
+    reference_fn, reference_ops = reference
+    calls = _calibrate(fn, min_time)
+    reference_calls = _calibrate(reference_fn, min_time)
+    rates = []
+    relative = []
+    for _ in range(repeat):
+        reference_rate = reference_calls * reference_ops / _run_calls(reference_fn, reference_calls)
+        rates.append(calls * ops / _run_calls(fn, calls))
+        relative.append(rates[-1] / reference_rate)
+
+    # occasional resizes of buffers and caches make single calls vary
+    peaks = []
+    block_counts = []
+    for _ in range(MEMORY_RUNS):
+        gc.collect()
+        tracemalloc.start()
+        blocks = sys.getallocatedblocks()
+        start_size, _ = tracemalloc.get_traced_memory()
+        # Python 3.9+; before that, the peak is only as old as the start() above
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        gc.collect()
+        peaks.append(peak - start_size)
+        block_counts.append(sys.getallocatedblocks() - blocks)
+    return max(rates), statistics.median(relative), min(peaks) / ops, max(min(block_counts), 0) / ops
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hot path microbenchmarks.')
+    parser.add_argument('-k', dest='filter', help='only benchmarks whose name contains this')
+    parser.add_argument('--save', action='store_true', help='store results as the new baseline')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed relative regression, e.g. 0.2 for 20%%')
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum seconds per measurement')
+    parser.add_argument('--repeat', type=int, default=5, help='measurements of each benchmark')
+    args = parser.parse_args()
+
+    reference = reference_workload()
+
+    logging.basicConfig(level=logging.ERROR)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print('{:32} {:>14} {:>12} {:>12} {:>10}'.format('benchmark', 'ops/sec', 'peak B/op', 'blocks/op', 'vs base'))
+    # HAP-python persists its state to the working directory
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            for name, setup in BENCHMARKS.items():
+                if args.filter and args.filter not in name:
+                    continue
+                fn, ops = setup(loop)
+                if not ops:
+                    print('{:32} skipped, no input'.format(name))
+                    continue
+                rate, relative, peak, blocks = measure(fn, ops, args.min_time, args.repeat, reference)
+                if args.save:
+                    # a baseline off by the noise of one measurement would skew all comparisons
+                    relative = statistics.median([relative] + [
+                        measure(fn, ops, args.min_time, args.repeat, reference)[1] for _ in range(CONFIRM_RUNS - 1)])
+                results[name] = {'ops_per_sec': rate, 'relative_speed': relative, 'peak_bytes_per_op': peak,
+                                 'blocks_per_op': blocks}
+                base = baseline.get(name)
+                change = ''
+                if base and 'relative_speed' not in base:
+                    change = 'old base'
+                elif base:
+                    ratio = relative / base['relative_speed']
+                    if ratio < 1 - args.threshold:
+                        ratios = [ratio] + [measure(fn, ops, args.min_time, args.repeat, reference)[1] /
+                                            base['relative_speed'] for _ in range(CONFIRM_RUNS - 1)]
+                        ratio = sorted(ratios)[len(ratios) // 2]
+                    change = '{:+.0%}'.format(ratio - 1)
+                    if ratio < 1 - args.threshold:
+                        regressions.append('{}: {:.0%} of the baseline speed relative to the reference'.format(
+                                           name, ratio))
+                    # small absolute slack: allocations of a few bytes come and go
+                    if peak > base['peak_bytes_per_op'] * (1 + args.threshold) + 16:
+                        regressions.append('{}: {:.0f} peak bytes/op, baseline {:.0f}'.format(
+                                           name, peak, base['peak_bytes_per_op']))
+                print('{:32} {:14.0f} {:12.1f} {:12.2f} {:>10}'.format(name, rate, peak, blocks, change))
+        finally:
+            os.chdir(cwd)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('baseline saved to {}'.format(args.baseline))
+    elif regressions:
+        print('\nregressions beyond {:.0%}:'.format(args.threshold))
+        for r in regressions:
+            print('  ' + r)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
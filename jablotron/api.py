@@ -0,0 +1,165 @@
+#
+# Copyright (c) 2018-2020 Václav Slavík
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+"""
+Read-only JSON API with the state of the panels, served by web.HTTPServer:
+
+- /api/state returns the state with an ETag. With If-None-Match it returns
+  304 if nothing changed; adding ?wait=N makes it wait up to N seconds for a
+  change first (long polling).
+- /api/events is a stream of server-sent events, one with the whole state
+  after every change.
+
+The state is kept up to date from the panels' events and serialized only once
+per change, whatever the number of clients; the API never talks to a panel.
+"""
+
+import asyncio
+import json
+import logging
+import time
+
+from . import metrics, web
+from .core import EVENT_FLAG
+
+
+logger = logging.getLogger(__name__)
+
+# longest wait allowed to long-polling clients, in seconds
+MAX_WAIT = 300
+# interval of comments sent to event streams to detect disconnected clients
+KEEPALIVE_INTERVAL = 15
+
+SNAPSHOTS = metrics.Counter('jablotron_api_snapshots_total', 'Serializations of the state for the API.')
+WAITING_CLIENTS = metrics.Gauge('jablotron_api_waiting_clients',
+                                'Clients waiting for a change of the state (long-polling or streaming).')
+
+
+class StateAPI:
+    def __init__(self, loop, alarms):
+        self.loop = loop
+        self.alarms = alarms
+        self.version = 0
+        # distinguishes versions of different runs of the bridge in ETags
+        self._epoch = '{:x}'.format(int(time.time()))
+        # version, JSON and server-sent event of the last serialized state
+        self._snapshot = (None, None, None)
+        self._change = loop.create_future()
+        self._notify_scheduled = False
+        self._waiting = 0
+        WAITING_CLIENTS.labels().set_function(lambda: self._waiting)
+        for alarm in alarms:
+            alarm.add_event_listener(self._on_event)
+
+    def register(self, server):
+        server.route('/api/state', self.state_handler)
+        server.route('/api/events', self.events_handler)
+
+    def close(self):
+        for alarm in self.alarms:
+            alarm.remove_event_listener(self._on_event)
+
+    def _on_event(self, event, id, value):
+        # flags aren't part of the state, alarms show as its change
+        if event != EVENT_FLAG:
+            self.invalidate()
+
+    def invalidate(self):
+        """The state changed; clients are woken once per loop iteration, after all of the changes."""
+        self.version += 1
+        if not self._notify_scheduled:
+            self._notify_scheduled = True
+            self.loop.call_soon(self._notify)
+
+    def _notify(self):
+        self._notify_scheduled = False
+        change, self._change = self._change, self.loop.create_future()
+        change.set_result(None)
+
+    @property
+    def tag(self):
+        return '{}-{}'.format(self._epoch, self.version)
+
+    def snapshot(self):
+        """Return the state serialized as JSON; built only once per version."""
+        return self._serialize()[1]
+
+    def _serialize(self):
+        if self._snapshot[0] != self.version:
+            panels = []
+            for alarm in self.alarms:
+                panels.append({
+                    'id': alarm.id,
+                    'name': alarm.name,
+                    'state': alarm.current_state,
+                    'sections': {str(s): state for s, state in sorted(alarm.section_states.items())},
+                    'active_sensors': [{'id': s.id, 'name': s.name}
+                                       for s in sorted(alarm.active_sensors, key=lambda s: s.id)],
+                })
+            body = json.dumps({'version': self.version, 'panels': panels}).encode()
+            event = 'id: {}\ndata: '.format(self.tag).encode() + body + b'\n\n'
+            self._snapshot = (self.version, body, event)
+            SNAPSHOTS.labels().inc()
+        return self._snapshot
+
+    async def wait_for_change(self, version, timeout):
+        """Wait until the state is newer than version; returns False on timeout."""
+        self._waiting += 1
+        try:
+            while self.version == version:
+                await asyncio.wait_for(asyncio.shield(self._change), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiting -= 1
+
+    async def state_handler(self, request):
+        etag = '"{}"'.format(self.tag)
+        if request.headers.get('if-none-match') == etag:
+            try:
+                wait = min(float(request.query.get('wait', 0)), MAX_WAIT)
+            except ValueError:
+                return web.Response(b'Bad Request\n', status=400)
+            if wait <= 0 or not await self.wait_for_change(self.version, wait):
+                return web.Response(status=304, headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+            etag = '"{}"'.format(self.tag)
+        return web.Response(self.snapshot(), content_type='application/json',
+                            headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+
+    async def events_handler(self, request):
+        return web.Response(content_type='text/event-stream', headers={'Cache-Control': 'no-cache'},
+                            stream=self._events(request.headers.get('last-event-id')))
+
+    async def _events(self, last_event_id):
+        sent = None
+        while True:
+            if last_event_id == self.tag:
+                # the client has this version already, e.g. after reconnecting
+                sent = self.version
+            last_event_id = None
+            if sent != self.version:
+                sent, _, event = self._serialize()
+                yield event
+            elif not await self.wait_for_change(sent, KEEPALIVE_INTERVAL):
+                yield b': keepalive\n\n'
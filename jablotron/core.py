@@ -23,13 +23,20 @@
 import asyncio
 import binascii
 import collections
+import functools
+import heapq
+import itertools
+import json
 import logging
+import os
 import serial_asyncio
 import toml
 import re
-import threading
+import time
 import weakref
 
+from . import filters, logs, metrics
+
 
 logger = logging.getLogger(__name__)
 
@@ -45,11 +52,19 @@ class Sensor:
         self.homekit = None
         self.alarm = weakref.proxy(alarm)
         self.id = config['id']
+        self.configure(config)
+        self._value = False
+        # value reported to HomeKit, which may lag behind because of filter
+        self.reported = False
+        self.filter = None
+
+    def configure(self, config):
+        """Take name, model, section and kind from sensor's entry in configuration."""
         self.name = config.get('name', 'Sensor %d' % self.id)
         self.model = config.get('model', None)
+        self.section = config.get('section', None)
         kind = config.get('kind', None)
         self.kind = kind if kind in [Sensor.MOTION, Sensor.WINDOW] else Sensor.OTHER
-        self._value = False
 
     def __str__(self):
         return 'sensor #%d (%s) "%s"' % (self.id, self.kind, self.name)
@@ -63,8 +78,19 @@ class Sensor:
         if self._value == value:
             return
         self._value = value
+        if self.filter is None:
+            self.report(value)
+        else:
+            self.filter.update(value)
+
+    def report(self, value, delayed=False):
+        """Pass the sensor's (filtered) value on to HomeKit."""
+        self.reported = value
+        self.alarm.logger.info('sensor %s: %s', 'activated' if value else 'deactivated', self)
         if self.homekit:
             self.homekit.update(value)
+            if not delayed:
+                metrics.STAGE_HOMEKIT_NOTIFIED.observe(time.perf_counter() - self.alarm.rx_time)
 
 
 
@@ -80,6 +106,21 @@ STATE_NIGHT = 'night'
 STATE_AWAY = 'away'
 STATE_TRIGGERED = 'triggered'
 
+# flags reported by the panel for sections
+SECTION_FLAGS = ['INTERNAL_WARNING', 'EXTERNAL_WARNING', 'FIRE_ALARM', 'INTRUDER_ALARM', 'PANIC_ALARM', 'ENTRY', 'EXIT']
+
+# Events passed to listeners added with JablotronRS485.add_event_listener(),
+# as listener(event, id, value):
+EVENT_SENSOR = 1    # id of the sensor, value is True if it's active
+EVENT_SECTION = 2   # section number, value is its new SECTION_* state
+EVENT_FLAG = 3      # section number, value is (flag name, True if on)
+EVENT_ALARM = 4     # id is 0, value is the new alarm state name
+
+
+def sections_key(sections):
+    """Canonical, hashable form of sections' states, ignoring disarmed sections."""
+    return frozenset((s, state) for s, state in sections.items() if state != SECTION_DISARMED)
+
 
 class AlarmState:
     """Describe state of alarm in terms of its sections."""
@@ -90,20 +131,23 @@ class AlarmState:
             self.sections[s] = SECTION_ARMED
         for s in partial:
             self.sections[s] = SECTION_PARTIALLY_ARMED
+        self.key = sections_key(self.sections)
 
     def get_sections(self, state):
         for s, sst in self.sections.items():
             if sst == state:
                 yield s
 
+    def section_state(self, section):
+        return self.sections.get(section, SECTION_DISARMED)
+
     def matches(self, sections):
-        for s, state in self.sections.items():
-            if sections.get(s, SECTION_DISARMED) != state:
-                return False
-        for s, state in sections.items():
-            if self.sections.get(s, SECTION_DISARMED) != state:
-                return False
-        return True
+        return sections_key(sections) == self.key
+
+
+# Leading literal token of a handler's regex, either a plain word ("PRFSTATE ...")
+# or a group of alternative words ("(ENTRY|EXIT) ...").
+_regex_tokens = re.compile(r'(?:\(((?:[A-Z_:]+\|)*[A-Z_:]+)\)|([A-Z_:]+))(?: |$)')
 
 
 def response_handler(regex):
@@ -116,104 +160,868 @@ def response_handler(regex):
     return decorator
 
 
+def _response_tokens(regex):
+    """Return leading tokens of lines matched by regex, or None if it doesn't start with a literal."""
+    m = _regex_tokens.match(regex)
+    if not m:
+        return None
+    return (m.group(1) or m.group(2)).split('|')
+
+
+# Command priorities, lower values are sent first.
+PRIORITY_CONTROL = 0
+PRIORITY_QUERY = 10
+PRIORITY_POLL = 20
+
+DEFAULT_COMMAND_TIMEOUT = 2.0
+DEFAULT_COMMAND_RETRIES = 2
+# weight of a new sample in the moving average of round-trip time
+RTT_EWMA_WEIGHT = 0.2
+
+# Handlers recognizing the reply that completes a command, by command keyword.
+_command_replies = {
+    'VER': 'on_version',
+    'PRFSTATE': 'on_prfstate',
+    'STATE': 'on_state',
+    'SET': 'on_ok',
+    'SETP': 'on_ok',
+    'UNSET': 'on_ok',
+}
+# Commands putting sections into given state, in the order they're sent in.
+_section_commands = collections.OrderedDict([
+    (SECTION_DISARMED, 'UNSET'),
+    (SECTION_ARMED, 'SET'),
+    (SECTION_PARTIALLY_ARMED, 'SETP'),
+])
+# Commands that only query the panel; identical pending ones share one transaction.
+_query_commands = {'VER', 'PRFSTATE', 'STATE'}
+
+
+class CommandError(Exception):
+    """Error reported by the panel in reply to a command."""
+
+
+class Command:
+    """Command waiting in CommandQueue."""
+    def __init__(self, loop, text, reply, priority, seq, timeout, retries, requested_at):
+        self.text = text
+        self.reply = reply
+        self.priority = priority
+        self.seq = seq
+        self.timeout = timeout
+        self.retries = retries
+        self.requested_at = requested_at
+        self.future = loop.create_future()
+        self.waiter = None
+
+
+class CommandQueue:
+    """
+    Sends commands to the panel one at a time, most urgent first, and
+    completes them when their expected reply arrives.
+    """
+    def __init__(self, loop, write, panel=''):
+        self.loop = loop
+        self.write = write
+        self._ok = metrics.COMMANDS.labels(panel, 'ok')
+        self._errors = metrics.COMMANDS.labels(panel, 'error')
+        self._timeouts = metrics.COMMANDS.labels(panel, 'timeout')
+        self._rtt = metrics.COMMAND_RTT.labels(panel)
+        # moving average of round-trip time and number of commands that
+        # timed out since the last reply
+        self.rtt = None
+        self.timeouts_in_row = 0
+        self._queue = []
+        self._counter = itertools.count()
+        self._queries = {}
+        self._current = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        # commands cancelled while queued stay in the heap until their turn
+        return sum(1 for _, _, cmd in self._queue if not cmd.future.done())
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def submit(self, text, keyword, priority=PRIORITY_QUERY,
+               timeout=DEFAULT_COMMAND_TIMEOUT, retries=DEFAULT_COMMAND_RETRIES, requested_at=None):
+        """
+        Queue command and return future completed by its reply. requested_at
+        is perf_counter() time of the user action that caused the command.
+        """
+        if keyword in _query_commands:
+            cmd = self._queries.get(text)
+            if cmd is not None:
+                return cmd.future
+        cmd = Command(self.loop, text, _command_replies.get(keyword, 'on_ok'), priority, next(self._counter),
+                      timeout, retries, requested_at)
+        if keyword in _query_commands:
+            self._queries[text] = cmd
+        heapq.heappush(self._queue, (priority, cmd.seq, cmd))
+        self._wakeup.set()
+        return cmd.future
+
+    def cancel(self, future):
+        """Cancel command unless it's been sent already; returns True if it was cancelled."""
+        if self._current is not None and self._current.future is future:
+            return False
+        future.cancel()
+        return True
+
+    def reply_received(self, handler_name):
+        cmd = self._current
+        if cmd is not None and cmd.reply == handler_name and not cmd.waiter.done():
+            cmd.waiter.set_result(None)
+
+    def error_received(self, message):
+        cmd = self._current
+        if cmd is not None and not cmd.waiter.done():
+            cmd.waiter.set_exception(CommandError(message))
+
+    async def _run(self):
+        while True:
+            while not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            cmd = heapq.heappop(self._queue)[2]
+            if cmd.future.done():
+                # cancelled before it was sent
+                self._done(cmd)
+                continue
+            self._current = cmd
+            try:
+                await self._execute(cmd)
+            except asyncio.CancelledError:
+                # stopped because the connection was lost, send it again once it's back
+                if not cmd.future.done():
+                    heapq.heappush(self._queue, (cmd.priority, cmd.seq, cmd))
+                    cmd = None
+                raise
+            finally:
+                self._current = None
+                if cmd is not None:
+                    self._done(cmd)
+
+    async def _execute(self, cmd):
+        for attempt in range(cmd.retries + 1):
+            cmd.waiter = self.loop.create_future()
+            self.write(cmd.text)
+            sent = time.perf_counter()
+            if cmd.requested_at is not None:
+                metrics.STAGE_COMMAND_WRITTEN.observe(sent - cmd.requested_at)
+                cmd.requested_at = None
+            try:
+                await asyncio.wait_for(cmd.waiter, cmd.timeout)
+            except asyncio.TimeoutError:
+                logger.warning('no reply to %s%s', repr(cmd.text), ', retrying' if attempt < cmd.retries else '')
+                self._timeouts.inc()
+                self.timeouts_in_row += 1
+                continue
+            except CommandError as e:
+                self._errors.inc()
+                self.timeouts_in_row = 0
+                if not cmd.future.done():
+                    cmd.future.set_exception(e)
+                return
+            self._ok.inc()
+            rtt = time.perf_counter() - sent
+            self._rtt.observe(rtt)
+            self.rtt = rtt if self.rtt is None else self.rtt + RTT_EWMA_WEIGHT * (rtt - self.rtt)
+            self.timeouts_in_row = 0
+            if not cmd.future.done():
+                cmd.future.set_result(None)
+            return
+        if not cmd.future.done():
+            cmd.future.set_exception(asyncio.TimeoutError('no reply to {}'.format(repr(cmd.text))))
+
+    def _done(self, cmd):
+        if self._queries.get(cmd.text) is cmd:
+            del self._queries[cmd.text]
+
+
+DEFAULT_POLL_INTERVAL = 60
+DEFAULT_POLL_MIN_INTERVAL = 5
+DEFAULT_POLL_MAX_INTERVAL = 600
+DEFAULT_POLL_BANDWIDTH = 0.05
+DEFAULT_DEGRADED_RTT = 0.5
+
+
+class Poller:
+    """
+    Periodically re-reads PRFSTATE and STATE to catch reports the bridge
+    missed, and tells whether the link is degraded from its round-trip time.
+
+    Polls are `interval` seconds apart. After errors, timeouts or
+    unrecognized lines they are more frequent, down to `min_interval`; while
+    the panel keeps pushing reports on its own they back off up to
+    `max_interval`. In any case, polls take at most `bandwidth` share of the
+    link's capacity, and user commands always go first.
+    """
+    def __init__(self, alarm, config, panel=''):
+        self.alarm = alarm
+        self.interval = config.get('interval', DEFAULT_POLL_INTERVAL)
+        self.min_interval = config.get('min_interval', DEFAULT_POLL_MIN_INTERVAL)
+        self.max_interval = config.get('max_interval', DEFAULT_POLL_MAX_INTERVAL)
+        self.bandwidth = config.get('bandwidth', DEFAULT_POLL_BANDWIDTH)
+        self.degraded_rtt = config.get('degraded_rtt', DEFAULT_DEGRADED_RTT)
+        self.degraded = False
+        self.delay = self.interval
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._last_poll = None
+        self._rx_bytes = 0
+        self._suspicious = False
+        self._polls_ok = metrics.POLLS.labels(panel, 'ok')
+        self._polls_failed = metrics.POLLS.labels(panel, 'failed')
+        self._polls_skipped = metrics.POLLS.labels(panel, 'skipped')
+        metrics.LINK_RTT.labels(panel).set_function(lambda: alarm.commands.rtt or 0)
+        metrics.LINK_DEGRADED.labels(panel).set_function(lambda: int(self.degraded))
+
+    def start(self):
+        if self._task is None and self.interval:
+            self._last_poll = self.alarm.event_loop.time()
+            self._rx_bytes = self.alarm.rx_bytes
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def suspect(self):
+        """Something may have been missed, poll soon."""
+        self._suspicious = True
+        self._wakeup.set()
+
+    def _link_capacity(self):
+        # bytes per second; a character takes 10 bits on the wire
+        return self.alarm.baudrate / 10
+
+    async def _run(self):
+        loop = self.alarm.event_loop
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._last_poll + self.delay - loop.time())
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._suspicious:
+                self._suspicious = False
+                self.delay = self.min_interval
+                if loop.time() < self._last_poll + self.delay:
+                    continue
+            await self._poll()
+
+    async def _poll(self):
+        alarm = self.alarm
+        loop = alarm.event_loop
+        now = loop.time()
+        pushed = alarm.rx_bytes - self._rx_bytes
+        elapsed = max(now - self._last_poll, 1e-3)
+        # sensor reports pushed since the last poll are as good as polling them
+        poll_prfstate = alarm.prfstate_received_at is None or alarm.prfstate_received_at < self._last_poll
+        if pushed / elapsed > self.bandwidth * self._link_capacity():
+            # the link is busy with reports, back off
+            self.delay = min(self.delay * 2, self.max_interval)
+        elif self.delay < self.interval:
+            self.delay = min(self.delay * 2, self.interval)
+        else:
+            self.delay = self.interval
+
+        start_tx, start_rx = alarm.tx_bytes, alarm.rx_bytes
+        try:
+            if poll_prfstate:
+                await alarm.send_command('PRFSTATE', PRIORITY_POLL, retries=0)
+            else:
+                self._polls_skipped.inc()
+            await alarm.send_command('STATE', PRIORITY_POLL, retries=0)
+            self._polls_ok.inc()
+        except (CommandError, asyncio.TimeoutError) as e:
+            alarm.logger.warning('polling the panel failed: %s', e)
+            self._polls_failed.inc()
+            self.delay = self.min_interval
+        self._update_degraded()
+
+        # keep within the share of the link's capacity: a poll that took N
+        # bytes is followed by at least N / (bandwidth * capacity) seconds
+        cost = alarm.tx_bytes - start_tx + alarm.rx_bytes - start_rx
+        self.delay = max(self.delay, cost / (self.bandwidth * self._link_capacity()))
+        self._last_poll = loop.time()
+        self._rx_bytes = alarm.rx_bytes
+
+    def _update_degraded(self):
+        rtt = self.alarm.commands.rtt
+        timeouts = self.alarm.commands.timeouts_in_row
+        if self.degraded:
+            degraded = timeouts > 0 or (rtt is not None and rtt > self.degraded_rtt / 2)
+        else:
+            degraded = timeouts > 0 or (rtt is not None and rtt > self.degraded_rtt)
+        if degraded != self.degraded:
+            self.degraded = degraded
+            if degraded:
+                self.alarm.logger.warning('RS-485 link degraded: round-trip time %.0f ms, %d timeouts',
+                                          (rtt or 0) * 1000, timeouts)
+            else:
+                self.alarm.logger.info('RS-485 link recovered: round-trip time %.0f ms', (rtt or 0) * 1000)
+
+
+# Lines on the wire are delimited by CR, LF or any bytes that aren't valid ASCII.
+_line_delimiters = re.compile(rb'[\r\n\x80-\xff]+')
+
+DEFAULT_PORT = '/dev/ttyUSB0'
+DEFAULT_BAUDRATE = 9600
+DEFAULT_MAX_LINE_LENGTH = 512
+DEFAULT_STATE_SETTLE_TIMEOUT = 0.5
+DEFAULT_RECONNECT_DELAY = 0.5
+DEFAULT_RECONNECT_MAX_DELAY = 30
+# how long create_connections() waits for panels without snapshot to report
+DEFAULT_CONNECT_TIMEOUT = 30
+# delay before writing the snapshot after a change, to write less often
+SNAPSHOT_DELAY = 10
+
+
+class LineFramer:
+    """Splits bytes received from RS-485 into lines passed to callback."""
+    def __init__(self, callback, max_line_length=DEFAULT_MAX_LINE_LENGTH):
+        self.callback = callback
+        self.max_line_length = max_line_length
+        self.buffer = bytearray()
+        self._discarding = False
+
+    def reset(self):
+        self.buffer.clear()
+        self._discarding = False
+
+    def feed(self, data):
+        buf = self.buffer
+        # what was buffered before is an incomplete line, no need to scan it again
+        scan_from = len(buf)
+        buf += data
+        start = 0
+        with memoryview(buf) as view:
+            for m in _line_delimiters.finditer(buf, scan_from):
+                end = m.start()
+                if self._discarding:
+                    self._discarding = False
+                elif end > start:
+                    self.callback(str(view[start:end], 'ascii'))
+                start = m.end()
+        if start:
+            del buf[:start]
+        if len(buf) > self.max_line_length:
+            logger.warning('discarding line longer than %d bytes', self.max_line_length)
+            buf.clear()
+            self._discarding = True
+
+
+def load_config(config_file):
+    """
+    Return list of configurations of panels in config_file. Panels are
+    listed in its [[panels]] tables, which inherit top-level settings; a
+    configuration without them describes a single panel with id None.
+    """
+    config = toml.load(config_file)
+    panels = config.pop('panels', None)
+    if panels is None:
+        config['id'] = None
+        return [config]
+    result = []
+    for panel in panels:
+        # the history file stores panel ids in one byte
+        if not isinstance(panel.get('id'), int) or not 1 <= panel['id'] <= 255:
+            raise ValueError('panels must have a numeric id from 1 to 255')
+        if any(p['id'] == panel['id'] for p in result):
+            raise ValueError('duplicate panel id {}'.format(panel['id']))
+        panel_config = dict(config, **panel)
+        if 'snapshot_file' in config and 'snapshot_file' not in panel:
+            base, ext = os.path.splitext(config['snapshot_file'])
+            panel_config['snapshot_file'] = '{}.{}{}'.format(base, panel['id'], ext)
+        result.append(panel_config)
+    return result
+
+
+def _create_states(config):
+    """Return OrderedDict of AlarmStates defined in config, disarmed first."""
+    states = collections.OrderedDict()
+    states[STATE_DISARMED] = AlarmState(STATE_DISARMED)
+    for s in config['states']:
+        st = AlarmState(s['name'], armed=s.get('armed', []), partial=s.get('partial', []))
+        states[st.name] = st
+    return states
+
+
+# Result of JablotronRS485.reload(): lists of sensors that were added, removed
+# or whose name, model, section or kind changed.
+ConfigChanges = collections.namedtuple('ConfigChanges', ['alarm', 'added', 'removed', 'changed'])
+
+
 class JablotronRS485(asyncio.Protocol):
     """
+    Connection to one panel. config is a panel configuration from
+    load_config() or the name of a single-panel configuration file.
     """
-    def __init__(self, loop, config_file):
-        self.update_lock = threading.Lock()
+    def __init__(self, loop, config):
         self.homekit = None
-        self.config = toml.load(config_file)
+        self.config = load_config(config)[0] if isinstance(config, str) else config
+        self.id = self.config.get('id')
+        self.name = self.config.get('name', 'Alarm' if self.id is None else 'Alarm {}'.format(self.id))
+        panel = '' if self.id is None else str(self.id)
+        self.logger = logger if self.id is None else logger.getChild(str(self.id))
+        log_config = self.config.get('logging', {})
+        self.wire = logs.WireLog(self.id, log_config.get('wire_rate', logs.DEFAULT_WIRE_RATE),
+                                 log_config.get('wire_sample', 1))
         self.pin = self.config['pin']
         self.firmware_version = None
         self.hardware_version = None
         self.serial_number = None
         self.model = None
-        self.sensors = {s['id']: Sensor(self, s) for s in self.config.get('sensors', [])}
+        self._set_sensors({s['id']: Sensor(self, s) for s in self.config.get('sensors', [])})
+        self.timers = filters.TimerWheel(loop)
+        self._update_filters()
+        self._prfstate = None
+        self._prfstate_bits = 0
         self.section_states = {}
-        self.states = collections.OrderedDict()
-        self.states[STATE_DISARMED] = AlarmState(STATE_DISARMED)
-        for s in self.config['states']:
-            st = AlarmState(s['name'], armed=s.get('armed', []), partial=s.get('partial', []))
-            self.states[st.name] = st
-            for sec in st.sections:
-                self.section_states[sec] = STATE_DISARMED
+        self._set_states(_create_states(self.config))
         self.current_state = STATE_DISARMED
         self.current_state_pending = False
+        self.state_settle_timeout = self.config.get('state_settle_timeout', DEFAULT_STATE_SETTLE_TIMEOUT)
+        self._state_timer = None
+        self._state_deadline = None
+        self._reported_sections = set()
+        self._target_key = None
+        # transition to a state in progress, its last sent command and states
+        # of sections set by our commands that the panel hasn't reported yet
+        self._transition = None
+        self._transition_command = None
+        self._expected_sections = {}
         self.event_loop = loop
-        self.recognized_response_event = asyncio.Event(loop=loop)
-        self.initialized_event = asyncio.Event(loop=loop)
+        self.commands = CommandQueue(loop, self._write_command, panel)
+        self.initialized_event = asyncio.Event()
+        # perf_counter() time when the data being processed was received
+        self.rx_time = time.perf_counter()
+        self._state_changed_at = None
+        self._rx_bytes = metrics.RX_BYTES.labels(panel)
+        self._tx_bytes = metrics.TX_BYTES.labels(panel)
+        self._lines = metrics.LINES.labels(panel)
+        self._unrecognized_lines = metrics.UNRECOGNIZED_LINES.labels(panel)
+        self._reconnects = metrics.RECONNECTS.labels(panel)
+        self._recovery_seconds = metrics.RECOVERY_SECONDS.labels(panel)
+        metrics.COMMAND_QUEUE_DEPTH.labels(panel).set_function(self.commands.__len__)
+        self.poller = Poller(self, self.config.get('polling', {}), panel)
+        # loop time of the last PRFSTATE report
+        self.prfstate_received_at = None
         self.active_sensors = set()
         self.transport = None
-        self.buffer = ''
+        serial_config = self.config.get('serial', {})
+        self.port = serial_config.get('port', DEFAULT_PORT)
+        self.baudrate = serial_config.get('baudrate', DEFAULT_BAUDRATE)
+        self.reconnect_max_delay = serial_config.get('reconnect_max_delay', DEFAULT_RECONNECT_MAX_DELAY)
+        self._init_task = None
+        self._reconnect_task = None
+        self._lost_at = None
+        self._closing = False
+        self.event_listeners = []
+        self.snapshot_file = self.config.get('snapshot_file')
+        self._snapshot_timer = None
+        if self.snapshot_file:
+            self._load_snapshot()
+        # pause after which a burst of STATE lines is considered complete: time
+        # to transmit two lines of 10-bit characters
+        self._state_burst_gap = 2 * 16 * 10 / self.baudrate
+        self.framer = LineFramer(self.line_received,
+                                 serial_config.get('max_line_length', DEFAULT_MAX_LINE_LENGTH))
+        # Lines are dispatched on their first word straight to the single handler
+        # for it; only handlers without a literal leading token (the version
+        # banner) are tried one by one.
         self._responses_map = {}
+        self._fallback_responses = []
         for fn in (getattr(self, x) for x in dir(self)):
             if callable(fn):
                 regex = getattr(fn, '_regex', None)
                 if regex:
-                    self._responses_map[re.compile('^{}$'.format(regex))] = fn
+                    handler = (re.compile(regex), fn)
+                    tokens = _response_tokens(regex)
+                    if tokens is None:
+                        self._fallback_responses.append(handler)
+                        continue
+                    for token in tokens:
+                        if token in self._responses_map:
+                            raise ValueError('response {} handled by both {} and {}'.format(
+                                             token, self._responses_map[token][1].__name__, fn.__name__))
+                        self._responses_map[token] = handler
+
+    def _update_filters(self):
+        """
+        Set up filters of sensors from [filters.<kind>] tables and sensors' own
+        settings; filters whose settings didn't change are kept as they are.
+        """
+        kinds_config = self.config.get('filters', {})
+        panel = '' if self.id is None else str(self.id)
+        for sensor_config in self.config.get('sensors', []):
+            sensor = self.sensors[sensor_config['id']]
+            options = dict(kinds_config.get(sensor.kind, {}))
+            options.update(sensor_config)
+            options = {k: options.get(k, 0) for k in filters.SensorFilter.OPTIONS}
+            if not any(options.values()):
+                options = None
+            if options == (sensor.filter.options if sensor.filter else None):
+                continue
+            if sensor.filter is not None:
+                sensor.filter.close()
+            sensor.filter = filters.SensorFilter(sensor, self.timers, panel, **options) if options else None
+            if sensor.reported != sensor.value:
+                # a deactivation held back by the old filter
+                sensor.report(sensor.value, delayed=True)
+
+    def _set_states(self, states):
+        self.states = states
+        for st in states.values():
+            for sec in st.sections:
+                self.section_states.setdefault(sec, SECTION_DISARMED)
+        # the first of identically defined states wins
+        self._states_by_key = {}
+        for st in states.values():
+            self._states_by_key.setdefault(st.key, st)
+
+    def _set_sensors(self, sensors):
+        self.sensors = sensors
+        # PRFSTATE bit -> Sensor, and mask of the bits of configured sensors
+        self._sensors_by_bit = [sensors.get(i) for i in range(max(sensors, default=-1) + 1)]
+        self._sensors_mask = sum(1 << sid for sid in sensors)
+
+    def reload(self, config):
+        """
+        Apply changed panel configuration from load_config() without
+        disconnecting: sensors, states, PIN, filters, polling and wire log
+        settings are updated in place, other serial settings need a restart.
+        Returns ConfigChanges with sensors whose HomeKit accessories are
+        affected; the sensors that were kept are the same objects.
+        """
+        if config.get('id') != self.id:
+            raise ValueError('configuration of panel {} given to panel {}'.format(config.get('id'), self.id))
+        # everything that can fail goes first, so that a bad file changes nothing
+        states = _create_states(config)
+        pin = config['pin']
+        sensor_configs = {s['id']: s for s in config.get('sensors', [])}
+
+        self.config = config
+        self.name = config.get('name', 'Alarm' if self.id is None else 'Alarm {}'.format(self.id))
+        self.pin = pin
+        self.state_settle_timeout = config.get('state_settle_timeout', DEFAULT_STATE_SETTLE_TIMEOUT)
+
+        added, changed = [], []
+        removed = dict(self.sensors)
+        sensors = {}
+        for sid, sensor_config in sensor_configs.items():
+            sensor = removed.pop(sid, None)
+            if sensor is None:
+                sensor = Sensor(self, sensor_config)
+                added.append(sensor)
+            else:
+                old = (sensor.name, sensor.model, sensor.section, sensor.kind)
+                sensor.configure(sensor_config)
+                if (sensor.name, sensor.model, sensor.section, sensor.kind) != old:
+                    changed.append(sensor)
+            sensors[sid] = sensor
+        for sensor in removed.values():
+            if sensor.filter is not None:
+                sensor.filter.close()
+            self.active_sensors.discard(sensor)
+        self._set_sensors(sensors)
+        # added sensors start from the panel's last report
+        bits = 0
+        if self._prfstate:
+            bits = int.from_bytes(binascii.unhexlify(self._prfstate), 'little') & self._sensors_mask
+        for sensor in self._sensors_for_bits(bits & ~self._prfstate_bits):
+            sensor._value = sensor.reported = True
+            self.active_sensors.add(sensor)
+        self._prfstate_bits = bits
+        self._update_filters()
+
+        self._set_states(states)
+        if self.serial_number is not None and not self.current_state_pending and \
+                self.current_state != STATE_TRIGGERED:
+            # the current sections may now be a differently named state
+            self._process_state_change()
+
+        panel = '' if self.id is None else str(self.id)
+        log_config = config.get('logging', {})
+        self.wire = logs.WireLog(self.id, log_config.get('wire_rate', logs.DEFAULT_WIRE_RATE),
+                                 log_config.get('wire_sample', 1))
+        polling = self.poller._task is not None
+        self.poller.stop()
+        self.poller = Poller(self, config.get('polling', {}), panel)
+        if polling:
+            self.poller.start()
+
+        serial_config = config.get('serial', {})
+        if (serial_config.get('port', DEFAULT_PORT), serial_config.get('baudrate', DEFAULT_BAUDRATE)) != \
+                (self.port, self.baudrate):
+            self.logger.warning('serial port settings will take effect after restart')
+        self.reconnect_max_delay = serial_config.get('reconnect_max_delay', DEFAULT_RECONNECT_MAX_DELAY)
+        self.framer.max_line_length = serial_config.get('max_line_length', DEFAULT_MAX_LINE_LENGTH)
+
+        self.logger.info('configuration reloaded: %d sensors added, %d removed, %d changed',
+                         len(added), len(removed), len(changed))
+        return ConfigChanges(self, added, list(removed.values()), changed)
+
+    async def connect(self):
+        """Open the serial port, with this object as its protocol."""
+        await serial_asyncio.create_serial_connection(self.event_loop, lambda: self, self.port,
+                                                      baudrate=self.baudrate)
+
+    def add_event_listener(self, listener):
+        """Call listener(event, id, value) for every EVENT_* change."""
+        self.event_listeners.append(listener)
+
+    def remove_event_listener(self, listener):
+        self.event_listeners.remove(listener)
+
+    def _emit(self, event, id, value):
+        for listener in self.event_listeners:
+            try:
+                listener(event, id, value)
+            except Exception:
+                self.logger.exception('event listener %s failed', listener)
+
+    @property
+    def rx_bytes(self):
+        return self._rx_bytes.value
+
+    @property
+    def tx_bytes(self):
+        return self._tx_bytes.value
+
+    def connect_in_background(self):
+        """Keep trying to open the serial port without waiting for it."""
+        self._reconnect_task = asyncio.ensure_future(self._reconnect(delay=0))
+
+    def close(self):
+        self._closing = True
+        self.poller.stop()
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        if self.transport is not None:
+            self.transport.close()
+        if self._snapshot_timer is not None:
+            self.save_snapshot()
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_file) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.logger.warning('ignoring unreadable snapshot %s: %s', self.snapshot_file, e)
+            return
+        self.model = snapshot['model']
+        self.serial_number = snapshot['serial_number']
+        self.firmware_version = snapshot['firmware_version']
+        self.hardware_version = snapshot['hardware_version']
+        for section, state in snapshot['sections'].items():
+            if state in _known_section_states:
+                self.section_states[int(section)] = state
+        if snapshot['state'] in self.states:
+            self.current_state = snapshot['state']
+        hex_state = snapshot['prfstate']
+        if hex_state:
+            self._prfstate = hex_state
+            self._prfstate_bits = int.from_bytes(binascii.unhexlify(hex_state), 'little') & self._sensors_mask
+            for sensor in self._sensors_for_bits(self._prfstate_bits):
+                sensor._value = sensor.reported = True
+                self.active_sensors.add(sensor)
+        self.logger.info('restored state of %s from %s', self.serial_number, self.snapshot_file)
+
+    def _snapshot_changed(self):
+        if self.snapshot_file and self._snapshot_timer is None:
+            self._snapshot_timer = self.event_loop.call_later(SNAPSHOT_DELAY, self.save_snapshot)
+
+    def save_snapshot(self):
+        """Write what is known about the panel to snapshot_file, to start from it next time."""
+        if self._snapshot_timer is not None:
+            self._snapshot_timer.cancel()
+            self._snapshot_timer = None
+        if self.serial_number is None:
+            return
+        snapshot = {
+            'model': self.model,
+            'serial_number': self.serial_number,
+            'firmware_version': self.firmware_version,
+            'hardware_version': self.hardware_version,
+            'sections': {str(s): state for s, state in self.section_states.items()},
+            'state': self.current_state,
+            'prfstate': self._prfstate,
+        }
+        tmp_file = self.snapshot_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_file, self.snapshot_file)
+        except OSError as e:
+            self.logger.error('failed to save snapshot %s: %s', self.snapshot_file, e)
 
     def connection_made(self, transport):
-        logger.info('RS-485 connection established')
-        self.buffer = ''
+        self.logger.info('RS-485 connection established')
+        self.framer.reset()
         self.transport = transport
-        self.recognized_response_event = asyncio.Event(loop=transport.loop)
-        asyncio.async(self._get_initial_state())
+        self._expected_sections.clear()
+        self.commands.start()
+        if self._init_task is None or self._init_task.done():
+            self._init_task = asyncio.ensure_future(self._get_initial_state())
 
     async def _get_initial_state(self):
-        await self.send_command('VER')
-        await self.send_command('PRFSTATE')
-        await self.send_command('STATE')
+        while True:
+            try:
+                # after reconnecting, the panel is known already
+                if self.serial_number is None:
+                    await self.send_command('VER')
+                await self.send_command('PRFSTATE')
+                await self.send_command('STATE')
+                break
+            except (CommandError, asyncio.TimeoutError) as e:
+                self.logger.error('failed to get initial state: %s', e)
+        if self._lost_at is not None:
+            recovery = self.event_loop.time() - self._lost_at
+            self._lost_at = None
+            self.logger.info('RS-485 connection recovered in %.1f s', recovery)
+            self._recovery_seconds.observe(recovery)
         self.initialized_event.set()
+        self.poller.start()
 
     def data_received(self, data):
-        self.buffer += data.decode('ascii', errors='replace')
-        while True:
-            split_in_two = re.split('[\r\n\ufffd]+', self.buffer, 1)
-            if len(split_in_two) == 1:
-                break
-            line, self.buffer = split_in_two
-            self.line_received(line)
+        self.rx_time = time.perf_counter()
+        self._rx_bytes.inc(len(data))
+        self.framer.feed(data)
 
-    async def send_command(self, text):
-        logger.info(' → %s', repr(text))
-        self.recognized_response_event.clear()
-        self.transport.write(text.encode() + b'\n')
-        await self.recognized_response_event.wait()
+    def _write_command(self, text):
+        self.wire.sent(text)
+        data = text.encode() + b'\n'
+        self._tx_bytes.inc(len(data))
+        self.transport.write(data)
 
-    async def send_authenticated_command(self, text):
-        await self.send_command('{} {}'.format(self.pin, text))
+    async def send_command(self, text, priority=PRIORITY_QUERY, **kwargs):
+        """Send command and wait for its reply; raises CommandError or asyncio.TimeoutError."""
+        keyword = text.split(' ', 1)[0]
+        future = self.commands.submit(text, keyword, priority, **kwargs)
+        if keyword in _query_commands:
+            # the reply may be shared with other callers
+            future = asyncio.shield(future)
+        await future
 
-    async def _do_set_alarm_state(self, state):
+    def set_alarm_state(self, state, requested_at=None):
+        """
+        Change the alarm to named state, superseding any change still in
+        progress. Must be called on the event loop (HomeKit setters are); the
+        first command is queued right away.
+        """
+        if requested_at is None:
+            requested_at = time.perf_counter()
         state = self.states[state]
-        logger.info('setting alarm to: %s (%s)', state.name, state.sections)
-        arm = set(state.get_sections(SECTION_ARMED))
-        arm_partially = set(state.get_sections(SECTION_PARTIALLY_ARMED))
-        disarm = set(self.section_states.keys()) - arm - arm_partially
+        self.logger.info('setting alarm to: %s (%s)', state.name, state.sections)
+        self._target_key = state.key
+        in_flight = self._cancel_transition()
+        first = None
+        if in_flight is None:
+            plan = self._plan_transition(state)
+            if not plan:
+                self.logger.info('alarm is already %s', state.name)
+                if sections_key(self.section_states) == state.key:
+                    self._target_key = None
+                return
+            first = self._submit_transition_command(*plan[0], requested_at=requested_at)
+        self._transition = asyncio.ensure_future(self._run_transition(state, first, in_flight))
+
+    def _plan_transition(self, state):
+        """
+        Return [(section state, sections)] to send to take the sections from
+        their expected states to those of state, in order of sending.
+        """
+        changes = collections.OrderedDict((st, []) for st in _section_commands)
+        for section in sorted(self.section_states):
+            current = self._expected_sections.get(section, self.section_states[section])
+            target = state.section_state(section)
+            if current != target:
+                changes[target].append(section)
+        return [(st, sections) for st, sections in changes.items() if sections]
+
+    def _submit_transition_command(self, section_state, sections, requested_at=None):
+        keyword = _section_commands[section_state]
+        text = '{} {}'.format(keyword, ' '.join(str(s) for s in sections))
+        future = self.commands.submit('{} {}'.format(self.pin, text), keyword, PRIORITY_CONTROL,
+                                      requested_at=requested_at)
+        future.add_done_callback(functools.partial(self._transition_command_done, section_state, sections))
+        self._transition_command = future
+        return future
+
+    def _transition_command_done(self, section_state, sections, future):
+        if not future.cancelled() and future.exception() is None:
+            # the panel may report the new state only later, e.g. after exit delay
+            for s in sections:
+                self._expected_sections[s] = section_state
 
-        if disarm:
-            await self.send_authenticated_command('UNSET {}'.format(' '.join(str(x) for x in disarm)))
-        if arm:
-            await self.send_authenticated_command('SET {}'.format(' '.join(str(x) for x in arm)))
-        if arm_partially:
-            await self.send_authenticated_command('SETP {}'.format(' '.join(str(x) for x in arm_partially)))
+    def _cancel_transition(self):
+        """
+        Stop transition in progress and drop its commands that weren't sent
+        yet; returns future of its command that was sent, if not completed.
+        """
+        if self._transition is not None:
+            self._transition.cancel()
+            self._transition = None
+        command, self._transition_command = self._transition_command, None
+        if command is None or command.done() or self.commands.cancel(command):
+            return None
+        return command
 
-    def set_alarm_state(self, state):
-        asyncio.run_coroutine_threadsafe(self._do_set_alarm_state(state), self.event_loop)
+    async def _run_transition(self, state, command, in_flight):
+        try:
+            if in_flight is not None:
+                # superseded transition's command can't be taken back, plan from its result
+                try:
+                    await asyncio.shield(in_flight)
+                except (CommandError, asyncio.TimeoutError):
+                    pass
+            while True:
+                if command is None:
+                    plan = self._plan_transition(state)
+                    if not plan:
+                        break
+                    command = self._submit_transition_command(*plan[0])
+                # shielded so that superseding the transition doesn't abandon a sent command
+                await asyncio.shield(command)
+                command = None
+        except (CommandError, asyncio.TimeoutError) as e:
+            self.logger.error('failed to set alarm to %s: %s', state.name, e)
+            if self._target_key == state.key:
+                self._target_key = None
 
     def line_received(self, line):
-        logger.info(' ← %s', repr(line))
+        self.wire.received(line, self.rx_time)
         if not line:
             return
-        for regex, fn in self._responses_map.items():
-            m = regex.match(line)
+        self._lines.inc()
+        handler = self._responses_map.get(line.split(' ', 1)[0])
+        for regex, fn in (handler,) if handler else self._fallback_responses:
+            m = regex.fullmatch(line)
             if m:
                 fn(*m.groups())
-                self.recognized_response_event.set()
+                self.commands.reply_received(fn.__name__)
+                metrics.STAGE_PARSED.observe(time.perf_counter() - self.rx_time)
                 return
-        logger.warning('unrecognized response %s, ignoring', repr(line))
-        self.recognized_response_event.set()
+        self._unrecognized_lines.inc()
+        self.logger.warning('unrecognized response %s, ignoring', repr(line))
+        self.poller.suspect()
 
-    @response_handler(r'OK|STATE:')
+    # header of the reply to STATE; OK is handled by on_ok
+    @response_handler(r'STATE:')
     def on_unimportant(self):
         pass
 
@@ -222,85 +1030,207 @@ class JablotronRS485(asyncio.Protocol):
         # TODO: note last update time
         pass
 
+    @response_handler(r'ERROR: (.*)')
+    def on_error(self, message):
+        self.logger.error('command failed: %s', message)
+        self.commands.error_received(message)
+        self.poller.suspect()
+
     # JA-121T, SN:1210037d, SWV:NN60202, HWV:1
     @response_handler(r'([^,]+), SN:(.*), SWV:(.*), HWV:(.*)')
     def on_version(self, model, sn, swv, hwv):
+        if self.serial_number is not None and (sn, swv) != (self.serial_number, self.firmware_version):
+            self.logger.info('panel changed from %s %s to %s %s', self.serial_number, self.firmware_version, sn, swv)
+        if (model, sn, swv, hwv) == (self.model, self.serial_number, self.firmware_version, self.hardware_version):
+            return
         self.model = model
         self.serial_number = sn
         self.firmware_version = swv
         self.hardware_version = hwv
+        self._snapshot_changed()
 
     @response_handler(r'STATE ([0-9]+) (READY|ARMED_PART|ARMED|SERVICE|BLOCKED|OFF)')
     def on_state(self, section, state):
         section = int(section)
-        logger.info('section %d reported state "%s"', section, state)
+        self.logger.info('section %d reported state "%s"', section, state)
+        self._expected_sections.pop(section, None)
         if state in _known_section_states:
-            self.section_states[section] = state
-            if not self.current_state_pending:
-                self.current_state_pending = True
-                self.event_loop.call_later(0.5, self._process_state_change)
+            if self.section_states.get(section) != state:
+                self.section_states[section] = state
+                self._snapshot_changed()
+                self._emit(EVENT_SECTION, section, state)
+            self._schedule_state_change(section)
         elif state == 'OFF':
             pass  # not used in this alarm
         else:
-            logger.warning('section %d in state %s', section, state)
+            self.logger.warning('section %d in state %s', section, state)
+
+    def _schedule_state_change(self, section):
+        """
+        Resolve alarm state once the panel is done reporting sections: when all
+        sections were reported, the target of our own command was reached, or
+        the link went quiet, but no later than state_settle_timeout.
+        """
+        now = self.event_loop.time()
+        if not self.current_state_pending:
+            self.current_state_pending = True
+            self._state_changed_at = self.rx_time
+            self._state_deadline = now + self.state_settle_timeout
+            self._reported_sections.clear()
+        self._reported_sections.add(section)
+        if self._state_timer is not None:
+            self._state_timer.cancel()
+            self._state_timer = None
+        if (self._reported_sections.issuperset(self.section_states) or
+                sections_key(self.section_states) == self._target_key):
+            self._process_state_change()
+        else:
+            self._state_timer = self.event_loop.call_at(min(now + self._state_burst_gap, self._state_deadline),
+                                                        self._process_state_change)
 
     def _process_state_change(self):
+        if self._state_timer is not None:
+            self._state_timer.cancel()
+            self._state_timer = None
         self.current_state_pending = False
-        new_state = None
-        for state in self.states.values():
-            if state.matches(self.section_states):
-                new_state = state.name
-                break
+        changed_at = self._state_changed_at or self.rx_time
+        self._state_changed_at = None
+        key = sections_key(self.section_states)
+        state = self._states_by_key.get(key)
+        new_state = state.name if state else None
+        if key == self._target_key:
+            self._target_key = None
+        metrics.STAGE_STATE_RESOLVED.observe(time.perf_counter() - changed_at)
         if new_state is None:
-            logger.warning('uncoregnized alarm sections state: %s', self.section_states)
+            self.logger.warning('uncoregnized alarm sections state: %s', self.section_states)
         elif new_state != self.current_state:
             self.current_state = new_state
-            logger.info('alarm state changed to: %s', new_state)
-            if self.homekit:
-                self.homekit.update(new_state)
+            self._snapshot_changed()
+            self.logger.info('alarm state changed to: %s', new_state)
+            self._update_homekit(new_state, changed_at)
+            self._emit(EVENT_ALARM, 0, new_state)
 
-    @response_handler(r'(INTERNAL_WARNING|EXTERNAL_WARNING|FIRE_ALARM|INTRUDER_ALARM|PANIC_ALARM|ENTRY|EXIT) ([0-9]+) (ON|OFF)')
+    def _update_homekit(self, state, changed_at):
+        if self.homekit:
+            self.homekit.update(state)
+            metrics.STAGE_HOMEKIT_NOTIFIED.observe(time.perf_counter() - changed_at)
+
+    @response_handler(r'({}) ([0-9]+) (ON|OFF)'.format('|'.join(SECTION_FLAGS)))
     def on_section_flag(self, flag, section, state):
         state = True if state == 'ON' else False
+        self._emit(EVENT_FLAG, int(section), (flag, state))
         if flag.endswith('_ALARM'):
             # TODO: keep track of all alarmed sections
             if state:
                 self.current_state = STATE_TRIGGERED
-                if self.homekit:
-                    self.homekit.update(self.current_state)
+                self._update_homekit(self.current_state, self.rx_time)
+                self._emit(EVENT_ALARM, 0, self.current_state)
             else:
                 self._process_state_change()
 
     @response_handler(r'PRFSTATE ([0-9A-Z]+)')
     def on_prfstate(self, hex_state):
-        state = binascii.unhexlify(hex_state)
-        currently_active = set()
-        for i in range(0, len(state)):
-            for j in range(0, 8):
-                if state[i] & (1 << j):
-                    sid = i * 8 + j
-                    if sid in self.sensors:
-                        currently_active.add(self.sensors[sid])
-
-        with self.update_lock:
-            old_active = self.active_sensors
-            self.active_sensors = currently_active
-
-        for sensor in old_active - currently_active:
-            logger.info('sensor deactivated: %s', sensor)
+        self.prfstate_received_at = self.event_loop.time()
+        # the panel repeats the same report most of the time
+        if hex_state == self._prfstate:
+            return
+        try:
+            state = binascii.unhexlify(hex_state)
+        except binascii.Error:
+            self.logger.warning('malformed peripherals state %s', repr(hex_state))
+            return
+        self._prfstate = hex_state
+        # bit i*8+j of the number is bit j of byte i, i.e. the peripheral's id
+        bits = int.from_bytes(state, 'little') & self._sensors_mask
+        changed = bits ^ self._prfstate_bits
+        if not changed:
+            return
+        self._prfstate_bits = bits
+
+        deactivated = list(self._sensors_for_bits(changed & ~bits))
+        activated = list(self._sensors_for_bits(changed & bits))
+        self.active_sensors.difference_update(deactivated)
+        self.active_sensors.update(activated)
+        self._snapshot_changed()
+
+        for sensor in deactivated:
             sensor.value = False
-        for sensor in currently_active - old_active:
-            logger.info('sensor activated: %s', sensor)
+            self._emit(EVENT_SENSOR, sensor.id, False)
+        for sensor in activated:
             sensor.value = True
+            self._emit(EVENT_SENSOR, sensor.id, True)
+
+    def _sensors_for_bits(self, bits):
+        while bits:
+            lowest = bits & -bits
+            yield self._sensors_by_bit[lowest.bit_length() - 1]
+            bits ^= lowest
 
     def connection_lost(self, exc):
-        logger.error('RS-485 connection lost')
+        self.transport = None
+        self.commands.stop()
+        self.poller.stop()
+        if self._closing:
+            return
+        self.logger.error('RS-485 connection lost: %s', exc)
+        self._lost_at = self.event_loop.time()
+        self._reconnect_task = asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self, delay=DEFAULT_RECONNECT_DELAY):
+        while True:
+            await asyncio.sleep(delay)
+            self._reconnects.inc()
+            try:
+                await self.connect()
+                return
+            except asyncio.CancelledError:
+                # an Exception before Python 3.8
+                raise
+            except Exception as e:
+                self.logger.warning('connecting to %s failed: %s', self.port, e)
+            delay = min(max(delay * 2, DEFAULT_RECONNECT_DELAY), self.reconnect_max_delay)
 
 
-async def create_connection(loop, config_file):
-    def factory():
-        return JablotronRS485(loop, config_file)
-    _, protocol = await serial_asyncio.create_serial_connection(loop, factory, '/dev/ttyUSB0', baudrate=9600)
-    await protocol.initialized_event.wait()
-    logger.info('JablotronRS485 protocol initiated')
+async def create_connection(loop, config, timeout=None):
+    """
+    Connect to panel and wait until its state is known, unless it's known
+    from the snapshot already. With timeout, a panel that can't be opened or
+    doesn't answer in time is logged and left connecting in the background
+    instead of raising or waiting forever.
+    """
+    protocol = JablotronRS485(loop, config)
+    if protocol.serial_number is not None:
+        # known from the snapshot, no need to wait for the panel
+        protocol.connect_in_background()
+        return protocol
+
+    async def connect():
+        await protocol.connect()
+        await protocol.initialized_event.wait()
+
+    if timeout is None:
+        await connect()
+    else:
+        try:
+            await asyncio.wait_for(connect(), timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            protocol.logger.error('%s on %s is not ready, continuing without it: %s', protocol.name, protocol.port,
+                                  str(e) or 'timed out')
+            if protocol.transport is None:
+                protocol.connect_in_background()
+            return protocol
+    protocol.logger.info('JablotronRS485 protocol initiated')
     return protocol
+
+
+async def create_connections(loop, config, timeout=DEFAULT_CONNECT_TIMEOUT):
+    """
+    Connect to all panels configured in config file or list from
+    load_config() at once; panels that aren't ready within timeout keep
+    connecting in the background, so that one dead panel doesn't hold up
+    the others.
+    """
+    configs = load_config(config) if isinstance(config, str) else config
+    return await asyncio.gather(*(create_connection(loop, c, timeout) for c in configs))
@@ -0,0 +1,249 @@
+#
+# Copyright (c) 2018-2020 Václav Slavík
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Emulator of the JA-121T RS-485 interface on a pseudo-terminal, for testing
+and benchmarking the bridge without a real panel.
+
+Run as `python -m jablotron.emulator` and point `serial.port` in the
+configuration to the printed device.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import time
+import tty
+
+from .core import LineFramer, SECTION_DISARMED, SECTION_ARMED, SECTION_PARTIALLY_ARMED
+
+
+logger = logging.getLogger(__name__)
+
+_arming_commands = {
+    'SET': SECTION_ARMED,
+    'SETP': SECTION_PARTIALLY_ARMED,
+    'UNSET': SECTION_DISARMED,
+}
+
+
+class Emulator:
+    """
+    Speaks the JA-121T protocol on the master side of a pseudo-terminal
+    whose slave device is available as `port`.
+    """
+    def __init__(self, loop, pin='4*1234', sections=(1,), peripherals=64,
+                 model='JA-121T', serial_number='1210037d', firmware_version='NN60202', exit_delay=0):
+        self.loop = loop
+        self.pin = pin
+        self.model = model
+        self.serial_number = serial_number
+        self.firmware_version = firmware_version
+        self.exit_delay = exit_delay
+        self.sections = {s: SECTION_DISARMED for s in sections}
+        # sections in exit delay -> timer that arms them
+        self._exit_delays = {}
+        self.peripheral_count = peripherals
+        self.peripherals = 0
+        self.commands_received = 0
+        self.last_write_time = None
+        self._output = bytearray()
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self.port = os.ttyname(self._slave)
+        self._framer = LineFramer(self.command_received)
+        loop.add_reader(self._master, self._read_ready)
+
+    def close(self):
+        self.loop.remove_reader(self._master)
+        self.loop.remove_writer(self._master)
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _read_ready(self):
+        try:
+            data = os.read(self._master, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        self._framer.feed(data)
+
+    def send(self, line):
+        """Send line to the bridge."""
+        idle = not self._output
+        self._output += line.encode('ascii') + b'\r\n'
+        if idle:
+            self._write_ready()
+
+    def _write_ready(self):
+        try:
+            written = os.write(self._master, self._output)
+        except (BlockingIOError, InterruptedError):
+            written = 0
+        if written:
+            self.last_write_time = time.perf_counter()
+            del self._output[:written]
+        if self._output:
+            self.loop.add_writer(self._master, self._write_ready)
+        else:
+            self.loop.remove_writer(self._master)
+
+    @property
+    def pending_output(self):
+        return len(self._output)
+
+    def prfstate(self):
+        data = self.peripherals.to_bytes((self.peripheral_count + 7) // 8, 'little')
+        return 'PRFSTATE {}'.format(data.hex().upper())
+
+    def set_peripheral(self, pid, active):
+        """Change state of peripheral pid and report it."""
+        if active:
+            self.peripherals |= 1 << pid
+        else:
+            self.peripherals &= ~(1 << pid)
+        self.send(self.prfstate())
+
+    def set_section(self, section, state):
+        """Change state of section and report it."""
+        if self.sections.get(section) == state:
+            return
+        self.sections[section] = state
+        self.send('STATE {} {}'.format(section, state))
+
+    def set_flag(self, flag, section, on):
+        self.send('{} {} {}'.format(flag, section, 'ON' if on else 'OFF'))
+
+    def command_received(self, line):
+        self.commands_received += 1
+        words = line.split()
+        if words == ['VER']:
+            self.send('{}, SN:{}, SWV:{}, HWV:1'.format(self.model, self.serial_number, self.firmware_version))
+        elif words == ['STATE']:
+            for section, state in sorted(self.sections.items()):
+                self.send('STATE {} {}'.format(section, state))
+        elif words == ['PRFSTATE']:
+            self.send(self.prfstate())
+        elif len(words) >= 2 and words[1] in _arming_commands:
+            self._arming_command_received(words[0], words[1], words[2:])
+        else:
+            logger.warning('unknown command %s', repr(line))
+            self.send('ERROR: 1 SYNTAX')
+
+    def _arming_command_received(self, pin, command, sections):
+        if pin != self.pin:
+            self.send('ERROR: 3 NO_ACCESS')
+            return
+        try:
+            sections = [int(s) for s in sections]
+        except ValueError:
+            self.send('ERROR: 1 SYNTAX')
+            return
+        if any(s not in self.sections for s in sections):
+            self.send('ERROR: 4 INVALID_VALUE')
+            return
+        self.send('OK')
+        state = _arming_commands[command]
+        for section in sections:
+            timer = self._exit_delays.pop(section, None)
+            if timer is not None:
+                timer.cancel()
+                self.set_flag('EXIT', section, False)
+            if state != SECTION_DISARMED and self.exit_delay:
+                self.set_flag('EXIT', section, True)
+                self._exit_delays[section] = self.loop.call_later(self.exit_delay, self._arm_after_exit_delay,
+                                                                  section, state)
+            else:
+                self.set_section(section, state)
+
+    def _arm_after_exit_delay(self, section, state):
+        del self._exit_delays[section]
+        self.set_flag('EXIT', section, False)
+        self.set_section(section, state)
+
+    async def replay(self, path):
+        """
+        Replay script of lines to send, one per line prefixed with the delay
+        in seconds since the previous one, e.g. "0.5 PRFSTATE 40000000".
+        """
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                delay, text = line.split(None, 1)
+                await asyncio.sleep(float(delay))
+                self.send(text)
+
+    async def run_scenario(self, scenario, rate, duration=None, peripherals=None):
+        """
+        Generate sensor activity: "realistic" toggles random peripherals at
+        random intervals averaging `rate` events/sec, "stress" at exactly
+        `rate` events/sec (or as fast as possible if rate is 0).
+        """
+        peripherals = peripherals or range(self.peripheral_count)
+        end = None if duration is None else self.loop.time() + duration
+        while end is None or self.loop.time() < end:
+            pid = random.choice(peripherals)
+            self.set_peripheral(pid, not self.peripherals & (1 << pid))
+            if scenario == 'realistic':
+                await asyncio.sleep(random.expovariate(rate))
+            elif rate:
+                await asyncio.sleep(1 / rate)
+            else:
+                while self._output:
+                    await asyncio.sleep(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulate JA-121T interface on a pseudo-terminal.')
+    parser.add_argument('--pin', default='4*1234', help='PIN accepted for arming commands')
+    parser.add_argument('--sections', type=int, nargs='+', default=[1], help='sections of the alarm')
+    parser.add_argument('--peripherals', type=int, default=64, help='number of peripherals')
+    parser.add_argument('--exit-delay', type=float, default=0, help='exit delay when arming, in seconds')
+    parser.add_argument('--scenario', choices=['realistic', 'stress'], help='generate sensor activity')
+    parser.add_argument('--rate', type=float, default=1, help='events/sec of the scenario')
+    parser.add_argument('--script', help='replay lines from this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    emulator = Emulator(loop, pin=args.pin, sections=args.sections,
+                        peripherals=args.peripherals, exit_delay=args.exit_delay)
+    print('JA-121T emulator listening on {}'.format(emulator.port), flush=True)
+    try:
+        if args.script:
+            loop.run_until_complete(emulator.replay(args.script))
+        if args.scenario:
+            loop.run_until_complete(emulator.run_scenario(args.scenario, args.rate))
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.close()
+
+
+if __name__ == '__main__':
+    main()
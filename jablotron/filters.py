@@ -0,0 +1,208 @@
+#
+# Copyright (c) 2018-2020 Václav Slavík
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+"""
+Filtering of sensor changes before they're reported to HomeKit, to keep
+flapping motion sensors from flooding controllers with notifications.
+"""
+
+import collections
+import math
+
+from . import metrics
+
+
+SUPPRESSED = metrics.Counter('jablotron_sensor_changes_suppressed_total',
+                             'Sensor changes not reported to HomeKit, by the filter that held them back.',
+                             ['panel', 'reason'])
+
+DEFAULT_RESOLUTION = 0.1
+DEFAULT_SLOTS = 512
+
+# length of the window in which changes are counted for max_rate, in seconds
+FLAP_WINDOW = 60
+
+
+class TimerWheel:
+    """
+    Cheap timers for many sensors: callbacks are kept in a ring of slots
+    `resolution` seconds apart and the whole wheel is driven by a single
+    loop timer, running only while some timers are pending. Scheduling and
+    cancelling are O(1).
+    """
+    def __init__(self, loop, resolution=DEFAULT_RESOLUTION, slots=DEFAULT_SLOTS):
+        self.loop = loop
+        self.resolution = resolution
+        self._slots = [[] for _ in range(slots)]
+        self._position = 0
+        self._count = 0
+        self._tick_handle = None
+        self._tick_time = None
+
+    def __len__(self):
+        return self._count
+
+    def call_later(self, delay, callback, *args):
+        """Call callback(*args) after delay, rounded up to resolution; returns handle to cancel()."""
+        if self._tick_handle is None:
+            self._tick_time = self.loop.time()
+            self._tick_handle = self.loop.call_at(self._tick_time + self.resolution, self._tick)
+        # ticks from now, counting the time already elapsed since the last one
+        ticks = max(1, math.ceil((self.loop.time() + delay - self._tick_time) / self.resolution - 1e-9))
+        rounds, offset = divmod(ticks - 1, len(self._slots))
+        # [rounds left, callback, args]; callback is None once cancelled
+        timer = [rounds, callback, args]
+        self._slots[(self._position + 1 + offset) % len(self._slots)].append(timer)
+        self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer[1] is not None:
+            timer[1] = None
+            self._count -= 1
+
+    def _tick(self):
+        self._position = (self._position + 1) % len(self._slots)
+        slot = self._slots[self._position]
+        due = []
+        remaining = []
+        for timer in slot:
+            if timer[1] is None:
+                continue
+            if timer[0]:
+                timer[0] -= 1
+                remaining.append(timer)
+            else:
+                due.append(timer)
+        self._slots[self._position] = remaining
+        self._tick_time += self.resolution
+        for timer in due:
+            callback, args = timer[1], timer[2]
+            if callback is not None:
+                timer[1] = None
+                self._count -= 1
+                callback(*args)
+        if self._count:
+            self._tick_handle = self.loop.call_at(self._tick_time + self.resolution, self._tick)
+        else:
+            self._tick_handle = None
+            for slot in self._slots:
+                slot.clear()
+
+
+class SensorFilter:
+    """
+    Decides when changes of a sensor are reported. Activations always go
+    through at once, so that no opening or movement is ever hidden; only
+    deactivations are held back:
+    - min_on: the sensor is reported active for at least this many seconds,
+    - off_delay: deactivation is reported only after the sensor stayed
+      inactive for this many seconds,
+    - max_rate: a sensor changing more than this many times a minute is
+      flapping; it's reported active until it has been quiet for a minute.
+    Changes undone before they were reported aren't reported at all.
+    """
+    OPTIONS = ('min_on', 'off_delay', 'max_rate')
+
+    def __init__(self, sensor, timers, panel='', min_on=0, off_delay=0, max_rate=0):
+        self.sensor = sensor
+        self.timers = timers
+        self.min_on = min_on
+        self.off_delay = off_delay
+        self.max_rate = max_rate
+        self.flapping = False
+        self._reported_at = None
+        self._off_at = None
+        self._changes = collections.deque()
+        self._timer = None
+        self._reason = None
+        self._suppressed = {reason: SUPPRESSED.labels(panel, reason) for reason in ('min_on', 'off_delay', 'flapping')}
+
+    @property
+    def options(self):
+        return {k: getattr(self, k) for k in self.OPTIONS}
+
+    def close(self):
+        """Drop the change being held back, if any."""
+        if self._timer is not None:
+            self.timers.cancel(self._timer)
+            self._timer = None
+
+    def update(self, value):
+        """Sensor changed to value."""
+        now = self.timers.loop.time()
+        if self.max_rate:
+            self._update_flapping(now)
+        if value:
+            if self._timer is not None:
+                # the deactivation wasn't reported, and neither is this
+                self.timers.cancel(self._timer)
+                self._timer = None
+                self._suppressed[self._reason].inc(2)
+            elif not self.sensor.reported:
+                self._report(True, now)
+            return
+        self._off_at = now
+        delay, self._reason = self._off_delay(now)
+        if delay > 0:
+            self._timer = self.timers.call_later(delay, self._release)
+        else:
+            self._report(False, now)
+
+    def _update_flapping(self, now):
+        changes = self._changes
+        changes.append(now)
+        while changes[0] < now - FLAP_WINDOW:
+            changes.popleft()
+        if not self.flapping and len(changes) > self.max_rate:
+            self.flapping = True
+            self.sensor.alarm.logger.warning('%s is flapping, reporting it active until it settles', self.sensor)
+
+    def _off_delay(self, now):
+        """Return seconds to wait before reporting deactivation, and why."""
+        delay, reason = 0, None
+        if self.flapping:
+            delay, reason = self._changes[-1] + FLAP_WINDOW - now, 'flapping'
+        if self._off_at + self.off_delay - now > delay:
+            delay, reason = self._off_at + self.off_delay - now, 'off_delay'
+        if self.min_on and self._reported_at is not None and self._reported_at + self.min_on - now > delay:
+            delay, reason = self._reported_at + self.min_on - now, 'min_on'
+        return delay, reason
+
+    def _release(self):
+        self._timer = None
+        now = self.timers.loop.time()
+        if self.flapping and self._changes[-1] + FLAP_WINDOW <= now + self.timers.resolution:
+            self.flapping = False
+            self._changes.clear()
+            self.sensor.alarm.logger.info('%s settled', self.sensor)
+        delay, self._reason = self._off_delay(now)
+        if delay >= self.timers.resolution:
+            self._timer = self.timers.call_later(delay, self._release)
+        elif not self.sensor.value:
+            self._report(False, now, delayed=True)
+
+    def _report(self, value, now, delayed=False):
+        if value:
+            self._reported_at = now
+        self.sensor.report(value, delayed)
@@ -0,0 +1,274 @@
+#
+# Copyright (c) 2018-2020 Václav Slavík
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+"""
+Persistent history of sensor and alarm events in a fixed-size ring file.
+
+The file starts with a header followed by `capacity` fixed-width records; when
+it's full, the oldest records are overwritten. New events are kept in memory
+and written in batches every `flush_interval` seconds to spare the SD card.
+File I/O runs on a worker thread so that it never blocks the event loop.
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import logging
+import mmap
+import os
+import struct
+import time
+
+from .core import EVENT_SENSOR, EVENT_SECTION, EVENT_FLAG, SECTION_FLAGS, _known_section_states
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CAPACITY = 100000
+DEFAULT_FLUSH_INTERVAL = 60
+
+_MAGIC = b'JBEH'
+_VERSION = 1
+# magic, version, record size, capacity, total number of records ever written
+_header = struct.Struct('<4sHHIQ12x')
+# time, event type, panel id (0 if there's only one), id, value
+_record = struct.Struct('<dBBHi')
+
+Event = collections.namedtuple('Event', ['time', 'event', 'panel', 'id', 'value'])
+
+
+def _encode_value(event, value):
+    if event == EVENT_SENSOR:
+        return int(value)
+    if event == EVENT_SECTION:
+        return _known_section_states.index(value)
+    if event == EVENT_FLAG:
+        flag, on = value
+        return SECTION_FLAGS.index(flag) << 1 | int(on)
+    return None
+
+
+def _decode_value(event, value):
+    if event == EVENT_SENSOR:
+        return bool(value)
+    if event == EVENT_SECTION:
+        return _known_section_states[value]
+    if event == EVENT_FLAG:
+        return (SECTION_FLAGS[value >> 1], bool(value & 1))
+    return value
+
+
+class EventHistory:
+    """
+    Ring file of events; use record() as the alarm's event listener, with
+    panel bound to the panel's id if there are several of them.
+    """
+    def __init__(self, loop, path, capacity=DEFAULT_CAPACITY, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 read_only=False):
+        self.loop = loop
+        self.read_only = read_only
+        self.path = path
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._flush_timer = None
+        self._flushing = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='history')
+        self._open()
+
+    def _open(self):
+        if self.read_only:
+            with open(self.path, 'rb') as f:
+                magic, version, record_size, self.capacity, self._written = _header.unpack(f.read(_header.size))
+                if (magic, version, record_size) != (_MAGIC, _VERSION, _record.size):
+                    raise ValueError('{} is not a history file'.format(self.path))
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return
+        size = _header.size + self.capacity * _record.size
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            header = os.read(fd, _header.size)
+            if len(header) == _header.size:
+                magic, version, record_size, capacity, written = _header.unpack(header)
+                if (magic, version, record_size, capacity) != (_MAGIC, _VERSION, _record.size, self.capacity):
+                    logger.warning('history file %s has different format or capacity, starting over', self.path)
+                    written = 0
+            else:
+                written = 0
+            os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._written = written
+        self._write_header()
+
+    def _write_header(self):
+        _header.pack_into(self._mmap, 0, _MAGIC, _VERSION, _record.size, self.capacity, self._written)
+
+    def record(self, event, id, value, panel=0):
+        """Add event to the history; it's written to the file on next flush."""
+        if self.read_only:
+            raise ValueError('history opened read-only')
+        value = _encode_value(event, value)
+        if value is None:
+            return
+        self._pending.append((time.time(), event, panel, id, value))
+        if self._flush_timer is None:
+            self._flush_timer = self.loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """Write pending events in the background; returns future of the write."""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if not self._pending:
+            return self._flushing
+        batch, self._pending = self._pending, []
+        self._flushing = self.loop.run_in_executor(self._executor, self._write, batch)
+        self._flushing.add_done_callback(self._on_written)
+        return self._flushing
+
+    def _on_written(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error('failed to write history to %s: %s', self.path, future.exception())
+
+    def _write(self, batch):
+        start = time.perf_counter()
+        mm = self._mmap
+        written = self._written + len(batch)
+        # if the batch is larger than the ring, only its tail survives anyway
+        batch = batch[-self.capacity:]
+        for index, rec in enumerate(batch, written - len(batch)):
+            _record.pack_into(mm, _header.size + (index % self.capacity) * _record.size, *rec)
+        self._written = written
+        self._write_header()
+        mm.flush()
+        logger.debug('wrote %d events to history in %.1f ms', len(batch), (time.perf_counter() - start) * 1000)
+
+    def close(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        written = None
+        if self._pending:
+            written = self._executor.submit(self._write, self._pending)
+            self._pending = []
+        self._executor.shutdown(wait=True)
+        if written is not None:
+            self._on_written(written)
+        self._mmap.close()
+
+    # Reading; the _read_* methods run on the worker thread, which also
+    # serializes them with writes.
+
+    def _time_at(self, index):
+        return _record.unpack_from(self._mmap, _header.size + (index % self.capacity) * _record.size)[0]
+
+    def _bisect(self, lo, hi, t):
+        # records are appended in time order, so the ring can be bisected
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._time_at(mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _read_records(self, start, end):
+        first = max(0, self._written - self.capacity)
+        lo = first if start is None else self._bisect(first, self._written, start)
+        hi = self._written if end is None else self._bisect(lo, self._written, end)
+        view = memoryview(self._mmap)
+        try:
+            records = []
+            # at most two contiguous slices of the ring
+            while lo < hi:
+                pos = lo % self.capacity
+                count = min(hi - lo, self.capacity - pos)
+                offset = _header.size + pos * _record.size
+                records += _record.iter_unpack(view[offset:offset + count * _record.size])
+                lo += count
+            return records
+        finally:
+            view.release()
+
+    async def _records(self, start, end):
+        pending = [r for r in self._pending
+                   if (start is None or r[0] >= start) and (end is None or r[0] < end)]
+        records = await self.loop.run_in_executor(self._executor, self._read_records, start, end)
+        return records + pending
+
+    async def query(self, event=None, id=None, start=None, end=None, panel=None):
+        """
+        Return list of Events, oldest first, optionally only of given type,
+        id, panel and between times start (inclusive) and end (exclusive).
+        """
+        return [Event(t, e, p, i, _decode_value(e, v))
+                for t, e, p, i, v in await self._records(start, end)
+                if (event is None or e == event) and (id is None or i == id) and (panel is None or p == panel)]
+
+    async def counts(self, event=EVENT_SENSOR, start=None, end=None, panel=0):
+        """
+        Return dict of id to number of activations (sensor active, flag on,
+        section armed) on the panel between times start and end.
+        """
+        result = collections.Counter()
+        for t, e, p, i, v in await self._records(start, end):
+            if e != event or p != panel:
+                continue
+            if v & 1 if e == EVENT_FLAG else v:
+                result[i] += 1
+        return dict(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show events from the history file.')
+    parser.add_argument('file', help='history file')
+    parser.add_argument('--sensor', type=int, help='only events of this sensor')
+    parser.add_argument('--hours', type=float, help='only events from the last N hours')
+    parser.add_argument('--panel', type=int, help='only events of this panel')
+    parser.add_argument('--counts', action='store_true', help='print activations per sensor')
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    history = EventHistory(loop, args.file, read_only=True)
+    start = time.time() - args.hours * 3600 if args.hours else None
+    try:
+        if args.counts:
+            counts = loop.run_until_complete(history.counts(start=start, panel=args.panel or 0))
+            for sid, count in sorted(counts.items()):
+                print('{:4} {:8}'.format(sid, count))
+        else:
+            event = EVENT_SENSOR if args.sensor is not None else None
+            for e in loop.run_until_complete(history.query(event, args.sensor, start, panel=args.panel)):
+                print(datetime.datetime.fromtimestamp(e.time).isoformat(' ', 'milliseconds'),
+                      e.event, e.panel, e.id, e.value)
+    finally:
+        history.close()
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -28,7 +28,8 @@ from pyhap.accessory_driver import AccessoryDriver
 from pyhap.accessory import Accessory
 from pyhap.const import CATEGORY_ALARM_SYSTEM, CATEGORY_SENSOR
 
-from .core import Sensor, STATE_DISARMED, STATE_AWAY, STATE_HOME, STATE_NIGHT, STATE_TRIGGERED
+from . import metrics
+from .core import JablotronRS485, Sensor, STATE_DISARMED, STATE_AWAY, STATE_HOME, STATE_NIGHT, STATE_TRIGGERED
 
 _core_to_homekit = {
     STATE_HOME: 0,
@@ -42,15 +43,70 @@ _homekit_to_core = {c: s for s, c in _core_to_homekit.items()}
 
 logger = logging.getLogger(__name__)
 
+# Accessories of panel N have ids from N * AIDS_PER_PANEL, so that they stay
+# the same when panels are added or removed: the alarm is the first one and
+# sensors follow, numbered by their ids.
+AIDS_PER_PANEL = 1000
+_SENSOR_AID_OFFSET = 10
+
+NOTIFICATIONS = metrics.Counter('jablotron_homekit_notifications_total',
+                                'Characteristic changes, by whether they were sent or coalesced away.', ['result'])
+
+
+class NotificationBatcher:
+    """
+    Collects characteristic changes made during one iteration of the event
+    loop and notifies HomeKit controllers of them together. A characteristic
+    changed several times is notified only once, and not at all if it ended
+    up with its original value.
+    """
+    def __init__(self, driver):
+        self.driver = driver
+        self._pending = {}
+        self._scheduled = False
+        self._sent = NOTIFICATIONS.labels('sent')
+        self._coalesced = NOTIFICATIONS.labels('coalesced')
+
+    def set_value(self, char, value):
+        if char in self._pending:
+            self._coalesced.inc()
+        self._pending[char] = value
+        if not self._scheduled:
+            self._scheduled = True
+            self.driver.loop.call_soon(self.flush)
+
+    def flush(self):
+        self._scheduled = False
+        pending, self._pending = self._pending, {}
+        changed = []
+        for char, value in pending.items():
+            value = char.to_valid_value(value)
+            if char.value == value:
+                self._coalesced.inc()
+                continue
+            char.set_value(value, should_notify=False)
+            if char.broker:
+                changed.append(char)
+        if changed:
+            self._sent.inc(len(changed))
+            self._publish(changed)
+
+    def _publish(self, chars):
+        # the driver queues events per connection and sends them together
+        for char in chars:
+            char.notify()
+
 
 class HKSensor(Accessory):
 
     category = CATEGORY_SENSOR
 
-    def __init__(self, driver, sensor):
-        super().__init__(driver, sensor.name)
+    def __init__(self, driver, sensor, notifier=None, aid=None):
+        super().__init__(driver, sensor.name, aid)
         self.char = None
+        self.notifier = notifier or NotificationBatcher(driver)
         self.sensor = sensor
+        self.kind = sensor.kind
         sensor.homekit = weakref.proxy(self)
         char = driver.loader.get_char('FirmwareRevision')
         self.get_service('AccessoryInformation').add_characteristic(char)
@@ -60,59 +116,100 @@ class HKSensor(Accessory):
                               firmware_revision=sensor.alarm.firmware_version)
 
     def update(self, value):
-        self.char.set_value(value)
+        self.notifier.set_value(self.char, value)
+
+    def reconfigure(self):
+        """Follow changed name and model of the sensor."""
+        _set_name(self, self.sensor.name)
+        self.set_info_service(model=self.sensor.model)
 
 
 class MotionSensor(HKSensor):
-    def __init__(self, driver, sensor):
-        super().__init__(driver, sensor)
+    def __init__(self, driver, sensor, notifier=None, aid=None):
+        super().__init__(driver, sensor, notifier, aid)
         service = self.add_preload_service('MotionSensor')
-        self.char = service.configure_char('MotionDetected')
+        self.char = service.configure_char('MotionDetected', value=sensor.reported)
 
 
 class ContactSensor(HKSensor):
-    def __init__(self, driver, sensor):
-        super().__init__(driver, sensor)
+    def __init__(self, driver, sensor, notifier=None, aid=None):
+        super().__init__(driver, sensor, notifier, aid)
         service = self.add_preload_service('ContactSensor')
-        self.char = service.configure_char('ContactSensorState')
+        self.char = service.configure_char('ContactSensorState', value=sensor.reported)
 
 
-def create_sensor_accessory(driver, sensor):
+def create_sensor_accessory(driver, sensor, notifier=None, aid=None):
     if sensor.kind == Sensor.MOTION:
-        return MotionSensor(driver, sensor)
+        return MotionSensor(driver, sensor, notifier, aid)
     elif sensor.kind == Sensor.WINDOW:
-        return ContactSensor(driver, sensor)
+        return ContactSensor(driver, sensor, notifier, aid)
     else:
-        return ContactSensor(driver, sensor)
+        return ContactSensor(driver, sensor, notifier, aid)
 
 
 class Alarm(Accessory):
     category = CATEGORY_ALARM_SYSTEM
 
-    def __init__(self, driver, core_alarm, config, aid=None):
-        super().__init__(driver, 'Alarm', aid)
+    def __init__(self, driver, core_alarm, config, aid=None, notifier=None):
+        super().__init__(driver, core_alarm.name, aid)
         self.alarm = core_alarm
+        self.notifier = notifier or NotificationBatcher(driver)
         serv_alarm = self.add_preload_service('SecuritySystem')
         current_state = _core_to_homekit.get(core_alarm.current_state, 3)
         self.char_current_state = serv_alarm.configure_char('SecuritySystemCurrentState', value=current_state)
         self.char_target_state = serv_alarm.configure_char('SecuritySystemTargetState', value=current_state,
                                                            setter_callback=self.set_hk_alarm_state)
         self.toggles = {}
+        self._toggle_services = {}
         for s in config.get('fake_buttons', []):
-            serv_button = self.add_preload_service('Switch', chars=['Name'])
-            serv_button.configure_char('Name', value='Alarm→{}'.format(s))
-            self.toggles[s] = serv_button.configure_char('On', setter_callback=lambda x, s=s: self.toggle_fake_button(s, x))
+            self._add_toggle(s)
 
         core_alarm.homekit = weakref.proxy(self)
 
+    def _add_toggle(self, state):
+        serv_button = self.add_preload_service('Switch', chars=['Name'])
+        serv_button.configure_char('Name', value='{}→{}'.format(self.alarm.name, state))
+        self.toggles[state] = serv_button.configure_char('On', value=self.alarm.current_state == state,
+                                                         setter_callback=lambda x: self.toggle_fake_button(state, x))
+        self._toggle_services[state] = serv_button
+
+    def _remove_toggle(self, state):
+        del self.toggles[state]
+        serv_button = self._toggle_services.pop(state)
+        self.services.remove(serv_button)
+        for obj in [serv_button] + serv_button.characteristics:
+            self.iid_manager.remove_obj(obj)
+
+    def reconfigure(self, config):
+        """
+        Follow changed name of the panel and fake_buttons in its HomeKit
+        config; returns True if anything changed.
+        """
+        changed = False
+        if self.display_name != self.alarm.name:
+            _set_name(self, self.alarm.name)
+            for state, serv_button in self._toggle_services.items():
+                serv_button.get_characteristic('Name').set_value('{}→{}'.format(self.alarm.name, state),
+                                                                 should_notify=False)
+            changed = True
+        buttons = config.get('fake_buttons', [])
+        for s in [s for s in self.toggles if s not in buttons]:
+            self._remove_toggle(s)
+            changed = True
+        for s in buttons:
+            if s not in self.toggles:
+                self._add_toggle(s)
+                changed = True
+        return changed
+
     def update(self, value):
         state = _core_to_homekit.get(value, 1)
         logger.info('setting homekit security state to %d from "%s"', state, value)
-        self.char_current_state.set_value(state)
+        self.notifier.set_value(self.char_current_state, state)
         if value != STATE_TRIGGERED:
-            self.char_target_state.set_value(state)
+            self.notifier.set_value(self.char_target_state, state)
         for name, button in self.toggles.items():
-            button.set_value(name == value)
+            self.notifier.set_value(button, name == value)
 
     def set_alarm_state(self, state):
         """Move security state to value if call came from HomeKit."""
@@ -130,28 +227,96 @@ class Alarm(Accessory):
             self.set_alarm_state(button)
 
 
-def create_driver(loop, core_alarm):
-    config = core_alarm.config.get('homekit', {})
-    use_bridge = core_alarm.sensors or config.get('use_bridge', False)
+def create_driver(loop, core_alarms, config=None):
+    """
+    Create HomeKit driver for one JablotronRS485 or a list of them; several
+    panels are always exposed through a bridge. The driver's settings come
+    from [homekit] of top-level config, or of the first panel if not given.
+    """
+    if isinstance(core_alarms, JablotronRS485):
+        core_alarms = [core_alarms]
+    first = core_alarms[0]
+    config = (first.config if config is None else config).get('homekit', {})
+    use_bridge = len(core_alarms) > 1 or first.sensors or config.get('use_bridge', False)
 
     driver = AccessoryDriver(loop=loop, port=config.get('port', 51001))
-    alarm = Alarm(driver, core_alarm, config)
-    alarm.set_info_service(model=core_alarm.model,
-                          manufacturer='Jablotron',
-                          serial_number=core_alarm.serial_number,
-                          firmware_revision=core_alarm.firmware_version)
-
-    if use_bridge:
-        bridge = Bridge(driver, display_name='Jablotron Bridge')
-        bridge.set_info_service(model=core_alarm.model,
-                                manufacturer='Jablotron',
-                                serial_number=core_alarm.serial_number,
-                                firmware_revision=core_alarm.firmware_version)
-        bridge.add_accessory(alarm)
-        for s in core_alarm.sensors.values():
-            bridge.add_accessory(create_sensor_accessory(driver, s))
-        driver.add_accessory(bridge)
-    else:
-        driver.add_accessory(alarm)
+    notifier = NotificationBatcher(driver)
+
+    if not use_bridge:
+        driver.add_accessory(_create_alarm_accessory(driver, first, notifier))
+        return driver
 
+    bridge = Bridge(driver, display_name='Jablotron Bridge')
+    bridge.set_info_service(model=first.model,
+                            manufacturer='Jablotron',
+                            serial_number=first.serial_number,
+                            firmware_revision=first.firmware_version)
+    for core_alarm in core_alarms:
+        # single-panel configurations keep the sequential ids they always had
+        base = None if core_alarm.id is None else core_alarm.id * AIDS_PER_PANEL
+        bridge.add_accessory(_create_alarm_accessory(driver, core_alarm, notifier,
+                                                     aid=None if base is None else base + 1))
+        for s in core_alarm.sensors.values():
+            aid = None if base is None else base + _SENSOR_AID_OFFSET + s.id
+            bridge.add_accessory(create_sensor_accessory(driver, s, notifier, aid))
+    driver.add_accessory(bridge)
     return driver
+
+
+def reload_driver(driver, changes):
+    """
+    Update accessories of driver from create_driver() after configuration of
+    its panels was reloaded; changes are ConfigChanges returned by
+    JablotronRS485.reload(). Accessories that remain keep their ids and
+    pairing, and controllers are told to refetch them if anything changed.
+    """
+    bridge = driver.accessory if isinstance(driver.accessory, Bridge) else None
+    updated = False
+    for change in changes:
+        core_alarm = change.alarm
+        alarm = driver.accessory if bridge is None else bridge.accessories[core_alarm.homekit.aid]
+        updated |= alarm.reconfigure(core_alarm.config.get('homekit', {}))
+        if bridge is None:
+            if change.added:
+                logger.warning('sensors can be added only after restart when not using bridge')
+            continue
+
+        for sensor in change.removed:
+            if sensor.homekit:
+                del bridge.accessories[sensor.homekit.aid]
+                updated = True
+        for sensor in change.changed:
+            acc = bridge.accessories[sensor.homekit.aid]
+            if acc.kind == sensor.kind:
+                acc.reconfigure()
+            else:
+                # different kind of sensor has different services, replace it
+                del bridge.accessories[acc.aid]
+                bridge.add_accessory(create_sensor_accessory(driver, sensor, alarm.notifier, acc.aid))
+            updated = True
+        for sensor in change.added:
+            if core_alarm.id is None:
+                aid = max(bridge.accessories, default=1) + 1
+                if aid == 7:
+                    aid += 1  # skipped by Bridge.add_accessory() too
+            else:
+                aid = core_alarm.id * AIDS_PER_PANEL + _SENSOR_AID_OFFSET + sensor.id
+            bridge.add_accessory(create_sensor_accessory(driver, sensor, alarm.notifier, aid))
+            updated = True
+    if updated:
+        driver.config_changed()
+    return updated
+
+
+def _set_name(acc, name):
+    acc.display_name = name
+    acc.get_service('AccessoryInformation').get_characteristic('Name').set_value(name, should_notify=False)
+
+
+def _create_alarm_accessory(driver, core_alarm, notifier, aid=None):
+    alarm = Alarm(driver, core_alarm, core_alarm.config.get('homekit', {}), aid=aid, notifier=notifier)
+    alarm.set_info_service(model=core_alarm.model,
+                           manufacturer='Jablotron',
+                           serial_number=core_alarm.serial_number,
+                           firmware_revision=core_alarm.firmware_version)
+    return alarm
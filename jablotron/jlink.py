@@ -0,0 +1,345 @@
+#
+# Copyright (c) 2018-2020 Václav Slavík
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+"""
+Reading of the XML export of peripherals from Jablotron's J-Link software,
+and merging of them into the bridge's configuration.
+
+The export is parsed incrementally, so that even large multi-site exports
+take constant memory.
+"""
+
+import collections
+import json
+import logging
+import os
+import re
+import shutil
+import toml
+import xml.etree.ElementTree as ET
+
+
+logger = logging.getLogger(__name__)
+
+Peripheral = collections.namedtuple('Peripheral', ['id', 'name', 'model', 'kind', 'section'])
+
+# kinds of peripherals that aren't sensors
+KIND_IGNORE = 'ignore'
+
+
+def get_sensor_kind(model: str):
+    if model.endswith('M'):
+        return 'window'
+    if model.endswith('P'):
+        return 'motion'
+    if model.endswith('B'):
+        return 'glassbreak'
+    if model.endswith('A'):  # alarms/sirens
+        return KIND_IGNORE
+    if model.endswith('E'):  # entry keypads
+        return KIND_IGNORE
+    if model.endswith('R'):  # radio modules
+        return KIND_IGNORE
+    if model == 'JA-121T':  # RS-485 interface
+        return KIND_IGNORE
+    if (model.startswith('JA-100K') or model.startswith('JA-101K') or
+            model.startswith('JA-106K')):  # control panel
+        return KIND_IGNORE
+    return None
+
+
+def _text(row, tag):
+    elem = row.find(tag)
+    return elem.text.strip() if elem is not None and elem.text else None
+
+
+def iter_peripherals(source):
+    """
+    Yield Peripheral for every row of the peripherals table of the export
+    in file or path source; kind is None if it's not recognized.
+    """
+    path = []
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem)
+            continue
+        path.pop()
+        if elem.tag == 'row' and path and path[-1].tag == 'table2':
+            model = _text(elem, 'type') or ''
+            section = re.match(r'\d+', _text(elem, 'section') or '')
+            yield Peripheral(id=int(_text(elem, 'position')),
+                             name=_text(elem, 'name'),
+                             model=model,
+                             kind=get_sensor_kind(model),
+                             section=int(section.group()) if section else None)
+        if len(path) == 2:
+            # rows of tables aren't needed anymore once processed
+            path[-1].remove(elem)
+
+
+def sensors_from_export(source):
+    """Return sensor entries for the configuration, and unrecognized Peripherals."""
+    sensors = []
+    unrecognized = []
+    for p in iter_peripherals(source):
+        if p.kind is None:
+            unrecognized.append(p)
+        elif p.kind != KIND_IGNORE:
+            sensors.append(_sensor_entry(p))
+    return sensors, unrecognized
+
+
+def _sensor_entry(peripheral):
+    entry = collections.OrderedDict([('id', peripheral.id), ('model', peripheral.model),
+                                     ('kind', peripheral.kind), ('name', peripheral.name)])
+    if peripheral.section is not None:
+        entry['section'] = peripheral.section
+    return entry
+
+
+MergeResult = collections.namedtuple('MergeResult', ['sensors', 'added', 'removed', 'updated', 'unrecognized'])
+
+
+def merge_sensors(existing, source, suppressed=()):
+    """
+    Merge sensors from the export in source into existing sensor entries.
+    Existing sensors keep their names, kinds and other settings, and get
+    model and section (and name or kind they don't have) from the export;
+    new sensors are added, except for ids in suppressed (sensors the user
+    commented out). Sensors no longer in the export are kept, but listed in
+    `removed`.
+    """
+    by_id = collections.OrderedDict((s['id'], dict(s)) for s in existing)
+    exported, unrecognized = sensors_from_export(source)
+    added, updated = [], []
+    for entry in exported:
+        current = by_id.get(entry['id'])
+        if current is None:
+            if entry['id'] in suppressed:
+                continue
+            by_id[entry['id']] = entry
+            added.append(entry['id'])
+            continue
+        for key in ('model', 'section'):
+            if key in entry and current.get(key) != entry[key]:
+                current[key] = entry[key]
+                updated.append(entry['id'])
+        for key in ('kind', 'name'):
+            current.setdefault(key, entry[key])
+    exported_ids = set(e['id'] for e in exported) | set(p.id for p in unrecognized)
+    removed = [sid for sid in by_id if sid not in exported_ids]
+    sensors = [by_id[sid] for sid in sorted(by_id)]
+    return MergeResult(sensors, added, removed, sorted(set(updated)), unrecognized)
+
+
+def check_sensors(sensors, source):
+    """Return list of differences between configured sensors and the export, as messages."""
+    configured = {s['id']: s for s in sensors}
+    exported = set()
+    problems = []
+    for p in iter_peripherals(source):
+        if p.kind is None or p.kind == KIND_IGNORE:
+            continue
+        exported.add(p.id)
+        s = configured.get(p.id)
+        if s is None:
+            problems.append('sensor #{} {} "{}" is in the J-Link export, but not configured'.format(
+                            p.id, p.model, p.name))
+            continue
+        if s.get('model', p.model) != p.model:
+            problems.append('sensor #{} is {} in the J-Link export, but {} in the configuration'.format(
+                            p.id, p.model, s['model']))
+        if s.get('section', p.section) != p.section:
+            problems.append('sensor #{} is in section {} in the J-Link export, but {} in the configuration'.format(
+                            p.id, p.section, s['section']))
+    for sid in sorted(set(configured) - exported):
+        problems.append('sensor #{} is configured, but not in the J-Link export'.format(sid))
+    return problems
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, str):
+        return json.dumps(value, ensure_ascii=False)
+    if isinstance(value, (list, tuple)):
+        return '[{}]'.format(', '.join(_format_value(v) for v in value))
+    if isinstance(value, dict):
+        return '{{ {} }}'.format(', '.join('{} = {}'.format(k, _format_value(v)) for k, v in value.items()))
+    return str(value)
+
+
+_REMOVED_NOTE = '# not in J-Link export anymore'
+
+
+def format_sensors(sensors, removed=(), unrecognized=(), commented=None, comments=None, notes=(), indent=''):
+    """
+    Return TOML `sensors = [...]` array of sensor entries, one per line and
+    ordered by id. Unrecognized Peripherals are included commented out, as
+    are the lines in commented (id -> line); comments are id -> comment
+    after the sensor's entry, and notes are other comment lines, put last.
+    """
+    commented = dict(commented or {})
+    comments = comments or {}
+    for p in unrecognized:
+        commented.setdefault(p.id, '# {{ id = {:2}, model = {}, name = {} }},  # unrecognized kind'.format(
+                             p.id, _format_value(p.model), _format_value(p.name or '')))
+    active = set(s['id'] for s in sensors)
+    entries = [(sid, line) for sid, line in commented.items() if sid not in active]
+    for s in sensors:
+        # the usual keys first, then any others in their original order
+        keys = [k for k in ('id', 'model', 'kind', 'name', 'section') if k in s]
+        keys += [k for k in s if k not in keys]
+        values = ['{} = {}'.format(k, '{:2}'.format(s[k]) if k == 'id' else _format_value(s[k])) for k in keys]
+        line = '{{ {} }},'.format(', '.join(values))
+        comment = comments.get(s['id'])
+        if s['id'] in removed:
+            comment = '{} {}'.format(_REMOVED_NOTE, comment[1:].strip()) if comment else _REMOVED_NOTE
+        if comment:
+            line += '  ' + comment
+        entries.append((s['id'], line))
+    lines = [indent + 'sensors = [']
+    lines += [indent + '  ' + line for _, line in sorted(entries, key=lambda e: e[0])]
+    lines += [indent + '  ' + note for note in notes]
+    lines.append(indent + ']')
+    return '\n'.join(lines)
+
+
+_table_header = re.compile(r'^\s*\[')
+_panel_id = re.compile(r'^\s*id\s*=\s*(\d+)')
+_sensors_start = re.compile(r'^(\s*)sensors\s*=\s*\[')
+_commented_sensor = re.compile(r'^#\s*\{.*?\bid\s*=\s*(\d+)')
+_sensor_id = re.compile(r'\bid\s*=\s*(\d+)')
+_string = re.compile(r'"(?:[^"\\]|\\.)*"')
+
+
+def _find_sensors(lines, panel=None):
+    """
+    Return (first, last) indexes of lines of the sensors array of panel (or
+    the top-level one), or (position to insert, None) if it has none.
+    """
+    # lines belonging to the wanted table
+    start, end = 0, len(lines)
+    if panel is None:
+        for i, line in enumerate(lines):
+            if _table_header.match(line):
+                end = i
+                break
+    else:
+        headers = [i for i, line in enumerate(lines) if _table_header.match(line)] + [len(lines)]
+        for i, h in enumerate(headers[:-1]):
+            if lines[h].strip() != '[[panels]]':
+                continue
+            ids = [_panel_id.match(line) for line in lines[h + 1:headers[i + 1]]]
+            if any(m and int(m.group(1)) == panel for m in ids):
+                start, end = h + 1, headers[i + 1]
+                break
+        else:
+            raise ValueError('panel {} not found'.format(panel))
+    for i in range(start, end):
+        if _sensors_start.match(lines[i]):
+            depth = 0
+            for j in range(i, len(lines)):
+                # brackets inside strings would confuse this, but names rarely have them
+                code = _string.sub('', lines[j]).split('#', 1)[0]
+                depth += code.count('[') - code.count(']')
+                if depth <= 0:
+                    return i, j
+            raise ValueError('unterminated sensors array')
+    while end > start and not lines[end - 1].strip():
+        end -= 1
+    return end, None
+
+
+def _parse_comments(lines):
+    """
+    Return comments in lines of a sensors array: commented-out sensor
+    entries (id -> line), comments after entries (id -> comment) and other
+    comment lines.
+    """
+    commented = collections.OrderedDict()
+    comments = {}
+    notes = []
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith('#'):
+            m = _commented_sensor.match(stripped)
+            if m:
+                commented[int(m.group(1))] = stripped
+            else:
+                notes.append(stripped)
+            continue
+        # blank out strings so that '#' in names isn't taken for a comment
+        code = _string.sub(lambda m: ' ' * len(m.group()), line)
+        start = code.find('#')
+        ids = _sensor_id.findall(code[:start] if start >= 0 else code)
+        if start < 0 or len(ids) != 1:
+            continue
+        comment = line[start:].strip()
+        if comment.startswith(_REMOVED_NOTE):
+            # added anew to sensors that are still missing
+            comment = '#' + comment[len(_REMOVED_NOTE):]
+        if comment.strip('# '):
+            comments[int(ids[0])] = comment
+    return commented, comments, notes
+
+
+def merge_into_config(config_file, source, panel=None):
+    """
+    Update sensors in config_file from the export in source, keeping the
+    rest of the file as it is. Returns MergeResult.
+    """
+    config = toml.load(config_file)
+    if panel is not None:
+        tables = [p for p in config.get('panels', []) if p.get('id') == panel]
+        if not tables:
+            raise ValueError('panel {} not found'.format(panel))
+        config = tables[0]
+    with open(config_file) as f:
+        lines = f.read().split('\n')
+    first, last = _find_sensors(lines, panel)
+    if last is None:
+        commented, comments, notes, indent = {}, {}, [], ''
+    else:
+        commented, comments, notes = _parse_comments(lines[first:last + 1])
+        indent = _sensors_start.match(lines[first]).group(1)
+
+    result = merge_sensors(config.get('sensors', []), source, suppressed=commented)
+    new = format_sensors(result.sensors, result.removed, result.unrecognized, commented, comments, notes,
+                         indent).split('\n')
+    if last is None:
+        lines[first:first] = new
+    else:
+        lines[first:last + 1] = new
+    tmp_file = config_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write('\n'.join(lines))
+    # the file holds the PIN, keep its permissions
+    shutil.copymode(config_file, tmp_file)
+    st = os.stat(config_file)
+    try:
+        os.chown(tmp_file, st.st_uid, st.st_gid)
+    except OSError:
+        pass
+    os.replace(tmp_file, config_file)
+    return result
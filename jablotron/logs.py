@@ -0,0 +1,139 @@
+#
+# Copyright (c) 2018-2020 Václav Slavík
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+"""
+Logging that stays off the event loop: records are passed through a queue to
+a thread that formats and writes them, and traffic on the serial link goes to
+the separate `jablotron.wire` logger, which is rate-limited and sampled.
+"""
+
+import logging
+import logging.handlers
+import queue
+import time
+
+from . import metrics
+
+
+WIRE_LOGGER = 'jablotron.wire'
+DEFAULT_WIRE_RATE = 20
+
+WIRE_LINES_SKIPPED = metrics.Counter('jablotron_wire_log_skipped_total',
+                                     'Lines on the serial link not logged because of sampling or rate limit.',
+                                     ['panel'])
+
+
+# arguments that can't change after the log call, so formatting them can wait
+_IMMUTABLE_ARGS = (str, bytes, int, float, type(None))
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Unlike the standard QueueHandler, leaves formatting of the message to
+    the listener's thread when all arguments are immutable scalars, as those
+    of the wire log are. Other messages are formatted right away, since their
+    arguments (dicts, lists, objects) may change before the listener gets
+    to them.
+    """
+    def prepare(self, record):
+        if record.exc_info:
+            # traceback must be formatted while its frames are still around
+            return super().prepare(record)
+        if record.args and not (isinstance(record.args, tuple) and
+                                all(isinstance(arg, _IMMUTABLE_ARGS) for arg in record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+def start_queue_logging():
+    """
+    Move handlers of the root logger to a background thread and log to them
+    through a queue. Returns the QueueListener, stop() it before exiting.
+    """
+    root = logging.getLogger()
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, *root.handlers, respect_handler_level=True)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(records))
+    listener.start()
+    return listener
+
+
+class WireLog:
+    """
+    Logs lines exchanged with a panel at INFO level, only every sample-th of
+    them and at most `rate` per second on average (0 for no limit). Nothing
+    is formatted for lines that aren't logged.
+
+    Records carry `panel`, `direction` ('rx' or 'tx'), `line`, `skipped`
+    (lines not logged since the previous record) and, for received lines,
+    `elapsed`: seconds since their data arrived.
+    """
+    def __init__(self, panel=None, rate=DEFAULT_WIRE_RATE, sample=1):
+        self.logger = logging.getLogger(WIRE_LOGGER if panel is None else '{}.{}'.format(WIRE_LOGGER, panel))
+        self.panel = panel
+        self.rate = rate
+        self.sample = sample
+        # allow bursts of up to a second worth of lines
+        self._burst = max(rate, 1)
+        self._tokens = self._burst
+        self._refilled_at = time.monotonic()
+        self._count = 0
+        self._skipped = 0
+        self._skipped_metric = WIRE_LINES_SKIPPED.labels('' if panel is None else str(panel))
+
+    def received(self, line, rx_time):
+        if self.logger.isEnabledFor(logging.INFO) and self._admit():
+            self._log('rx', '←', line, time.perf_counter() - rx_time)
+
+    def sent(self, line):
+        if self.logger.isEnabledFor(logging.INFO) and self._admit():
+            self._log('tx', '→', line, None)
+
+    def _admit(self):
+        self._count += 1
+        if self.sample > 1 and self._count % self.sample:
+            return self._skip()
+        if self.rate:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._refilled_at) * self.rate)
+            self._refilled_at = now
+            if self._tokens < 1:
+                return self._skip()
+            self._tokens -= 1
+        return True
+
+    def _skip(self):
+        self._skipped += 1
+        self._skipped_metric.inc()
+        return False
+
+    def _log(self, direction, arrow, line, elapsed):
+        skipped, self._skipped = self._skipped, 0
+        extra = {'panel': self.panel, 'direction': direction, 'line': line, 'skipped': skipped, 'elapsed': elapsed}
+        if skipped:
+            self.logger.info('%s %r (%d lines skipped)', arrow, line, skipped, extra=extra)
+        else:
+            self.logger.info('%s %r', arrow, line, extra=extra)
@@ -0,0 +1,199 @@
+#
+# Copyright (c) 2018-2020 Václav Slavík
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Counters and histograms of the bridge's performance, exported in Prometheus
+text format.
+
+Metrics are cheap to update: the hot path only increments numbers of a
+child object obtained once with labels().
+"""
+
+import bisect
+import math
+
+
+_registry = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for n, v in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        _registry.append(self)
+
+    def labels(self, *values):
+        """Return the metric for given label values."""
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def remove(self, *values):
+        self._children.pop(values, None)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for values, child in sorted(self._children.items()):
+            lines += child.render(self.name, self.labelnames, values)
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self, name, labelnames, values):
+        return ['{}{} {}'.format(name, _format_labels(labelnames, values), _format_value(self.value))]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+    _new_child = _CounterChild
+
+
+class _GaugeChild:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Compute the value by calling function when metrics are collected."""
+        self.function = function
+
+    def render(self, name, labelnames, values):
+        value = self.function() if self.function else self.value
+        return ['{}{} {}'.format(name, _format_labels(labelnames, values), _format_value(value))]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+    _new_child = _GaugeChild
+
+
+# Upper bounds of latency buckets, in seconds.
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name, labelnames, values):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            labels = _format_labels(labelnames, values, [('le', _format_value(bound))])
+            lines.append('{}_bucket{} {}'.format(name, labels, cumulative))
+        labels = _format_labels(labelnames, values)
+        lines.append('{}_sum{} {}'.format(name, labels, _format_value(self.sum)))
+        lines.append('{}_count{} {}'.format(name, labels, cumulative))
+        return lines
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+
+def render():
+    """Return all metrics in Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics of the serial link are labelled with the panel's id, empty if the
+# configuration has only one panel.
+RX_BYTES = Counter('jablotron_rx_bytes_total', 'Bytes received from the panel.', ['panel'])
+TX_BYTES = Counter('jablotron_tx_bytes_total', 'Bytes sent to the panel.', ['panel'])
+LINES = Counter('jablotron_lines_total', 'Lines received from the panel.', ['panel'])
+UNRECOGNIZED_LINES = Counter('jablotron_unrecognized_lines_total', 'Received lines that were not understood.',
+                             ['panel'])
+COMMANDS = Counter('jablotron_commands_total', 'Commands sent to the panel, by result.', ['panel', 'result'])
+COMMAND_RTT = Histogram('jablotron_command_rtt_seconds', 'Time from sending a command to its reply.', ['panel'])
+COMMAND_QUEUE_DEPTH = Gauge('jablotron_command_queue_depth', 'Commands waiting to be sent.', ['panel'])
+RECONNECTS = Counter('jablotron_reconnects_total', 'Attempts to reopen the serial link.', ['panel'])
+RECOVERY_SECONDS = Histogram('jablotron_recovery_seconds', 'Time from losing the serial link to having resynced.',
+                             ['panel'], buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+LINK_RTT = Gauge('jablotron_link_rtt_seconds', 'Moving average of command round-trip time.', ['panel'])
+LINK_DEGRADED = Gauge('jablotron_link_degraded', '1 if the serial link is slow or not answering, 0 otherwise.',
+                      ['panel'])
+POLLS = Counter('jablotron_polls_total', 'Background verifications of the panel state, by result.',
+                ['panel', 'result'])
+STAGE_LATENCY = Histogram('jablotron_stage_latency_seconds',
+                          'Time from receiving data (or a HomeKit request) to a processing stage.', ['stage'])
+
+# stages of STAGE_LATENCY:
+STAGE_PARSED = STAGE_LATENCY.labels('line_parsed')
+STAGE_STATE_RESOLVED = STAGE_LATENCY.labels('state_resolved')
+STAGE_HOMEKIT_NOTIFIED = STAGE_LATENCY.labels('homekit_notified')
+STAGE_COMMAND_WRITTEN = STAGE_LATENCY.labels('command_written')
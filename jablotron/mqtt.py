@@ -0,0 +1,268 @@
+#
+# Copyright (c) 2018-2020 Václav Slavík
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+"""
+Minimal MQTT 3.1.1 client publishing messages of a publisher.Subscription
+to a broker at QoS 0. Queued messages are written to the socket in batches
+and the client reconnects whenever the connection is lost; meanwhile the
+subscription's queue holds the latest messages.
+"""
+
+import asyncio
+import logging
+import struct
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 1883
+DEFAULT_KEEPALIVE = 60
+DEFAULT_CLIENT_ID = 'jablotron-bridge'
+DEFAULT_RECONNECT_DELAY = 1
+DEFAULT_RECONNECT_MAX_DELAY = 60
+# most messages written to the socket at once
+MAX_BATCH = 500
+# how long to wait for the broker to accept the TCP connection
+CONNECT_TIMEOUT = 10
+# how long to wait for DISCONNECT to be sent when stopping
+DISCONNECT_TIMEOUT = 1
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+_connect_flags = struct.Struct('!BBH')
+
+CONNECTIONS = metrics.Counter('jablotron_mqtt_connections_total', 'Attempts to connect to the MQTT broker, by result.',
+                              ['result'])
+CONNECTED = metrics.Gauge('jablotron_mqtt_connected', '1 if connected to the MQTT broker, 0 otherwise.')
+
+
+class MQTTError(Exception):
+    pass
+
+
+def _string(value):
+    data = value.encode() if isinstance(value, str) else value
+    return struct.pack('!H', len(data)) + data
+
+
+def packet(packet_type, body=b''):
+    """Return MQTT packet with fixed header of packet_type (including flags) and body."""
+    header = bytearray([packet_type])
+    length = len(body)
+    while True:
+        byte, length = length & 0x7F, length >> 7
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(header) + body
+
+
+def connect_packet(client_id, keepalive, username=None, password=None, will=None):
+    """will is (topic, payload) published by the broker, retained, when the client disappears."""
+    flags = 0x02  # clean session
+    payload = _string(client_id)
+    if will is not None:
+        flags |= 0x04 | 0x20
+        payload += _string(will[0]) + _string(will[1])
+    if username is not None:
+        flags |= 0x80
+        payload += _string(username)
+        if password is not None:
+            flags |= 0x40
+            payload += _string(password)
+    return packet(CONNECT, _string('MQTT') + _connect_flags.pack(4, flags, keepalive) + payload)
+
+
+def publish_packet(topic, payload, retain=False):
+    return packet(PUBLISH | int(retain), _string(topic) + payload.encode())
+
+
+async def read_packet(reader):
+    """Return (packet type with flags, body) of the next packet from reader."""
+    packet_type = (await reader.readexactly(1))[0]
+    length = 0
+    for shift in range(0, 28, 7):
+        byte = (await reader.readexactly(1))[0]
+        length |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            break
+    else:
+        raise MQTTError('malformed packet length')
+    return packet_type, await reader.readexactly(length)
+
+
+class MQTTClient:
+    """
+    Publishes messages of subscription to broker at host:port. With
+    status_topic, "online" is published to it after connecting and the
+    broker publishes "offline" when the bridge disappears. on_connect is
+    called after every (re)connection, to queue the current state for
+    retained topics that may have missed messages.
+    """
+    def __init__(self, loop, subscription, host, port=DEFAULT_PORT, client_id=DEFAULT_CLIENT_ID,
+                 username=None, password=None, keepalive=DEFAULT_KEEPALIVE, retain=True, status_topic=None,
+                 reconnect_max_delay=DEFAULT_RECONNECT_MAX_DELAY, on_connect=None):
+        self.loop = loop
+        self.subscription = subscription
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        self.username = username
+        self.password = password
+        self.keepalive = keepalive
+        self.retain = retain
+        self.status_topic = status_topic
+        self.reconnect_max_delay = reconnect_max_delay
+        self.on_connect = on_connect
+        self.connected = False
+        self._task = None
+        self._ping_sent = False
+        self._connected = CONNECTED.labels()
+        self._connections_ok = CONNECTIONS.labels('ok')
+        self._connections_failed = CONNECTIONS.labels('failed')
+
+    def start(self):
+        if self._task is None:
+            self._task = self.loop.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def close(self):
+        """Stop and wait until the broker has been told that the bridge is going away."""
+        task = self._task
+        self.stop()
+        if task is not None:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        delay = DEFAULT_RECONNECT_DELAY
+        while True:
+            try:
+                reader, writer = await self._connect()
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, MQTTError) as e:
+                self._connections_failed.inc()
+                logger.warning('connecting to MQTT broker %s:%d failed: %s', self.host, self.port, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.reconnect_max_delay)
+                continue
+            self._connections_ok.inc()
+            delay = DEFAULT_RECONNECT_DELAY
+            logger.info('connected to MQTT broker %s:%d', self.host, self.port)
+            self.connected = True
+            self._connected.set(1)
+            if self.on_connect is not None:
+                self.on_connect()
+            try:
+                await self._serve(reader, writer)
+            except (OSError, asyncio.IncompleteReadError, MQTTError) as e:
+                logger.warning('connection to MQTT broker lost: %s', e)
+            except asyncio.CancelledError:
+                if self.status_topic:
+                    writer.write(publish_packet(self.status_topic, 'offline', retain=True))
+                writer.write(packet(DISCONNECT))
+                writer.close()
+                try:
+                    await asyncio.wait_for(writer.wait_closed(), DISCONNECT_TIMEOUT)
+                except (OSError, asyncio.TimeoutError):
+                    pass
+                raise
+            finally:
+                self.connected = False
+                self._connected.set(0)
+                writer.close()
+
+    async def _connect(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), CONNECT_TIMEOUT)
+        try:
+            will = (self.status_topic, 'offline') if self.status_topic else None
+            writer.write(connect_packet(self.client_id, self.keepalive, self.username, self.password, will))
+            packet_type, body = await asyncio.wait_for(read_packet(reader), self.keepalive or DEFAULT_KEEPALIVE)
+            if packet_type != CONNACK or len(body) != 2:
+                raise MQTTError('unexpected reply to CONNECT')
+            if body[1]:
+                raise MQTTError('connection refused with code {}'.format(body[1]))
+        except BaseException:
+            writer.close()
+            raise
+        if self.status_topic:
+            writer.write(publish_packet(self.status_topic, 'online', retain=True))
+        return reader, writer
+
+    async def _serve(self, reader, writer):
+        # the broker only ever sends PINGRESP, read just to notice when it goes away
+        self._ping_sent = False
+        receiver = asyncio.ensure_future(self._receive(reader))
+        getter = None
+        # the last batch written; at QoS 0 there's no telling whether the
+        # broker got it before the connection was lost, so it's sent again
+        batch = []
+        try:
+            while True:
+                getter = asyncio.ensure_future(self.subscription.get_batch(MAX_BATCH))
+                done, _ = await asyncio.wait([getter, receiver], timeout=self.keepalive or None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if getter in done:
+                    batch = getter.result()
+                    getter = None
+                    writer.write(b''.join(publish_packet(topic, payload, self.retain)
+                                          for topic, payload in batch))
+                if receiver in done:
+                    receiver.result()
+                    raise MQTTError('broker closed the connection')
+                if not done:
+                    getter.cancel()
+                    getter = None
+                    if self._ping_sent:
+                        raise MQTTError('broker stopped responding')
+                    writer.write(packet(PINGREQ))
+                    self._ping_sent = True
+                await writer.drain()
+        finally:
+            receiver.cancel()
+            if getter is not None:
+                if getter.done() and not getter.cancelled() and getter.exception() is None:
+                    # taken off the queue but never written
+                    self.subscription.requeue(getter.result())
+                else:
+                    getter.cancel()
+            self.subscription.requeue(batch)
+
+    async def _receive(self, reader):
+        while True:
+            packet_type, _ = await read_packet(reader)
+            if packet_type & 0xF0 == PINGRESP:
+                self._ping_sent = False
+            else:
+                logger.debug('ignoring MQTT packet type %#x', packet_type)
@@ -0,0 +1,256 @@
+#
+# Copyright (c) 2018-2020 Václav Slavík
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+"""
+On-demand introspection of the running bridge:
+
+- a sampling CPU profile of the event loop's thread, as collapsed stacks
+  ready for flamegraph.pl or speedscope,
+- tracemalloc snapshots diffed against the previous one, with sizes of the
+  bridge's own buffers,
+- event loop lag, and callbacks that ran longer than a threshold, by name.
+
+Nothing runs until asked for: the sampler is a thread started for the
+duration of a profile, memory tracing starts with the first snapshot, and
+callbacks are timed only while lag is measured.
+"""
+
+import asyncio
+import collections
+import contextlib
+import functools
+import linecache
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+from . import web
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DURATION = 10
+MAX_DURATION = 300
+DEFAULT_SAMPLE_INTERVAL = 0.005
+DEFAULT_SLOW_CALLBACK = 0.01
+# interval of the timer whose lateness is the loop lag
+LAG_PROBE_INTERVAL = 0.05
+TRACEMALLOC_FRAMES = 10
+MEMORY_TOP = 25
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+
+
+def _callback_name(handle):
+    callback = handle._callback
+    owner = getattr(callback, '__self__', None)
+    if isinstance(owner, asyncio.Task):
+        # Task.get_coro() is new in Python 3.8
+        coro = owner.get_coro() if hasattr(owner, 'get_coro') else owner._coro
+        return 'task {}'.format(coro.__qualname__)
+    while isinstance(callback, functools.partial):
+        callback = callback.func
+    return getattr(callback, '__qualname__', repr(callback))
+
+
+class Profiler:
+    """
+    Introspection of the bridge running alarms on loop. Reports are returned
+    as text and, when triggered by signals, written to output_dir.
+    """
+    def __init__(self, loop, alarms, output_dir='.'):
+        self.loop = loop
+        self.alarms = alarms
+        self.output_dir = output_dir
+        self._running = set()
+        self._snapshot = None
+
+    def install_signal_handlers(self):
+        """SIGUSR1 profiles CPU and measures lag for DEFAULT_DURATION, SIGUSR2 diffs memory."""
+        self.loop.add_signal_handler(signal.SIGUSR1, lambda: self.loop.create_task(self._profile_to_file()))
+        self.loop.add_signal_handler(signal.SIGUSR2, lambda: self._write_report('memory', self.memory_report()))
+
+    def register(self, server):
+        server.route('/debug/profile', self.profile_handler)
+        server.route('/debug/lag', self.lag_handler)
+        server.route('/debug/memory', self.memory_handler)
+
+    async def profile(self, duration=DEFAULT_DURATION, interval=DEFAULT_SAMPLE_INTERVAL):
+        """Sample stacks of the loop's thread for duration seconds; returns them collapsed, one per line."""
+        with self._exclusive('profile'):
+            counts = collections.Counter()
+            await self.loop.run_in_executor(None, self._sample, threading.get_ident(), duration, interval, counts)
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in counts.most_common())
+
+    @staticmethod
+    def _sample(thread_id, duration, interval, counts):
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            counts[';'.join(reversed(stack))] += 1
+            time.sleep(interval)
+
+    async def measure_lag(self, duration=DEFAULT_DURATION, slow_callback=DEFAULT_SLOW_CALLBACK):
+        """
+        Measure how late the loop runs timers for duration seconds, timing
+        all callbacks meanwhile; returns report with those slower than
+        slow_callback seconds.
+        """
+        # at least one probe, so that there is something to report
+        duration = max(duration, LAG_PROBE_INTERVAL)
+        with self._exclusive('lag measurement'):
+            lags = []
+            slow = collections.defaultdict(lambda: [0, 0.0, 0.0])  # name -> count, total, max
+            original_run = asyncio.events.Handle._run
+
+            def timed_run(handle):
+                start = time.perf_counter()
+                original_run(handle)
+                elapsed = time.perf_counter() - start
+                if elapsed >= slow_callback:
+                    entry = slow[_callback_name(handle)]
+                    entry[0] += 1
+                    entry[1] += elapsed
+                    entry[2] = max(entry[2], elapsed)
+
+            asyncio.events.Handle._run = timed_run
+            try:
+                deadline = self.loop.time() + duration
+                while self.loop.time() < deadline:
+                    expected = self.loop.time() + LAG_PROBE_INTERVAL
+                    await asyncio.sleep(LAG_PROBE_INTERVAL)
+                    lags.append(max(0, self.loop.time() - expected))
+            finally:
+                asyncio.events.Handle._run = original_run
+
+        lags.sort()
+        lines = ['loop lag over {:g} s: p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms'.format(
+                 duration, lags[len(lags) // 2] * 1000, lags[min(len(lags) - 1, len(lags) * 99 // 100)] * 1000,
+                 lags[-1] * 1000)]
+        lines.append('callbacks slower than {:.0f} ms:'.format(slow_callback * 1000))
+        for name, (count, total, longest) in sorted(slow.items(), key=lambda x: -x[1][1]):
+            lines.append('  {:6d}x  total {:8.1f} ms  max {:7.1f} ms  {}'.format(count, total * 1000,
+                                                                             longest * 1000, name))
+        return '\n'.join(lines) + '\n'
+
+    def memory_report(self, limit=MEMORY_TOP):
+        """
+        Return allocations grown since the previous call and sizes of the
+        bridge's buffers; the first call only starts tracing.
+        """
+        lines = []
+        for alarm in self.alarms:
+            lines.append('{}: receive buffer {} B, active sensors {}, queued commands {}, timers {}, '
+                         'event listeners {}'.format(alarm.name, len(alarm.framer.buffer), len(alarm.active_sensors),
+                                                     len(alarm.commands), len(alarm.timers),
+                                                     len(alarm.event_listeners)))
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self._snapshot = None
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, linecache.__file__),
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+        lines.append('traced memory {:.1f} KiB, peak {:.1f} KiB'.format(current / 1024, peak / 1024))
+        if self._snapshot is None:
+            lines.append('tracing started, allocations will be compared to this point next time')
+        else:
+            lines.append('largest changes since the previous report:')
+            for stat in snapshot.compare_to(self._snapshot, 'lineno')[:limit]:
+                lines.append('  {}'.format(stat))
+        self._snapshot = snapshot
+        return '\n'.join(lines) + '\n'
+
+    def stop_memory_tracing(self):
+        tracemalloc.stop()
+        self._snapshot = None
+
+    @contextlib.contextmanager
+    def _exclusive(self, kind):
+        if kind in self._running:
+            raise ProfilerBusy('{} already in progress'.format(kind))
+        self._running.add(kind)
+        try:
+            yield
+        finally:
+            self._running.discard(kind)
+
+    async def _profile_to_file(self):
+        stacks, lag = await asyncio.gather(self.profile(), self.measure_lag(), return_exceptions=True)
+        for kind, report, ext in (('profile', stacks, '.collapsed'), ('lag', lag, '.txt')):
+            if isinstance(report, ProfilerBusy):
+                logger.warning('%s', report)
+            elif isinstance(report, Exception):
+                logger.error('%s failed: %s', kind, report)
+            else:
+                self._write_report(kind, report, ext)
+
+    def _write_report(self, kind, report, ext='.txt'):
+        path = os.path.join(self.output_dir, 'jablotron-{}-{}{}'.format(kind, time.strftime('%Y%m%d-%H%M%S'), ext))
+        try:
+            with open(path, 'w') as f:
+                f.write(report)
+        except OSError as e:
+            logger.error('failed to write %s: %s', path, e)
+            return
+        logger.info('wrote %s', path)
+
+    async def profile_handler(self, request):
+        return await self._handle(request, self.profile)
+
+    async def lag_handler(self, request):
+        return await self._handle(request, self.measure_lag)
+
+    async def memory_handler(self, request):
+        if request.query.get('stop'):
+            self.stop_memory_tracing()
+            return web.Response(b'memory tracing stopped\n')
+        return web.Response(self.memory_report().encode())
+
+    async def _handle(self, request, measure):
+        try:
+            duration = min(float(request.query.get('seconds', DEFAULT_DURATION)), MAX_DURATION)
+        except ValueError:
+            return web.Response(b'Bad Request\n', status=400)
+        if not duration > 0:
+            return web.Response(b'Bad Request\n', status=400)
+        try:
+            return web.Response((await measure(duration)).encode())
+        except ProfilerBusy as e:
+            return web.Response('{}\n'.format(e).encode(), status=409)
@@ -0,0 +1,222 @@
+#
+# Copyright (c) 2018-2020 Václav Slavík
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+"""
+Fan-out of the panels' events to subscribers, such as the MQTT client.
+
+Events are published as (topic, payload) messages into a bounded queue of
+every subscriber, so that a slow or disconnected subscriber never holds up
+the serial link: when its queue is full, it loses messages by its overflow
+policy instead. Subscribers take queued messages in batches.
+
+Topics are <prefix>/state, <prefix>/section/<n>, <prefix>/sensor/<id> and
+<prefix>/flag/<section>/<flag>, with the panel's id after the prefix if it
+has one.
+"""
+
+import collections
+import logging
+
+from . import metrics
+from .core import EVENT_SENSOR, EVENT_SECTION, EVENT_FLAG, EVENT_ALARM
+
+
+logger = logging.getLogger(__name__)
+
+# Overflow policies of subscriptions:
+# the oldest message is dropped to make room for a new one
+DROP_OLDEST = 'drop_oldest'
+# a message replaces the queued one of the same topic, so that only the
+# latest value of each topic waits; only if the queue is full of distinct
+# topics is the oldest dropped
+COALESCE = 'coalesce'
+
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_PREFIX = 'jablotron'
+
+PUBLISHED = metrics.Counter('jablotron_publisher_messages_total', 'Messages queued for subscribers.',
+                            ['subscriber'])
+DROPPED = metrics.Counter('jablotron_publisher_dropped_total',
+                          'Messages dropped from full queues or replaced by newer ones of their topic.',
+                          ['subscriber', 'reason'])
+DELIVERED = metrics.Counter('jablotron_publisher_delivered_total', 'Messages taken from queues by subscribers.',
+                            ['subscriber'])
+QUEUE_DEPTH = metrics.Gauge('jablotron_publisher_queue_depth', 'Messages waiting in subscriber queues.',
+                            ['subscriber'])
+BATCH_SIZE = metrics.Histogram('jablotron_publisher_batch_size', 'Messages taken by subscribers at once.',
+                               ['subscriber'], buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+
+
+class Subscription:
+    """
+    Bounded queue of messages for one subscriber, from Publisher.subscribe().
+    """
+    def __init__(self, loop, name, maxsize=DEFAULT_QUEUE_SIZE, overflow=COALESCE):
+        if overflow not in (DROP_OLDEST, COALESCE):
+            raise ValueError('unknown overflow policy {}'.format(overflow))
+        self.loop = loop
+        self.name = name
+        self.maxsize = maxsize
+        self.overflow = overflow
+        # topic -> payload when coalescing, (topic, payload) otherwise
+        self._queue = collections.OrderedDict() if overflow == COALESCE else collections.deque()
+        self._waiter = None
+        self._published = PUBLISHED.labels(name)
+        self._overflowed = DROPPED.labels(name, 'overflow')
+        self._coalesced = DROPPED.labels(name, 'coalesced')
+        self._delivered = DELIVERED.labels(name)
+        self._batch_size = BATCH_SIZE.labels(name)
+        QUEUE_DEPTH.labels(name).set_function(self.__len__)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, topic, payload):
+        """Queue message without ever blocking."""
+        self._published.inc()
+        queue = self._queue
+        if self.overflow == COALESCE:
+            if topic in queue:
+                # keeps the topic's place in the queue
+                queue[topic] = payload
+                self._coalesced.inc()
+                return
+            if len(queue) >= self.maxsize:
+                queue.popitem(last=False)
+                self._overflowed.inc()
+            queue[topic] = payload
+        else:
+            if len(queue) >= self.maxsize:
+                queue.popleft()
+                self._overflowed.inc()
+            queue.append((topic, payload))
+        if self._waiter is not None:
+            if not self._waiter.done():
+                self._waiter.set_result(None)
+            self._waiter = None
+
+    async def get_batch(self, max_messages=None):
+        """Wait for messages and return list of (topic, payload) of all queued, up to max_messages."""
+        while not self._queue:
+            self._waiter = self.loop.create_future()
+            await self._waiter
+        queue = self._queue
+        count = len(queue) if max_messages is None else min(len(queue), max_messages)
+        if self.overflow == COALESCE:
+            batch = [queue.popitem(last=False) for _ in range(count)]
+        else:
+            batch = [queue.popleft() for _ in range(count)]
+        self._delivered.inc(count)
+        self._batch_size.observe(count)
+        return batch
+
+    def requeue(self, batch):
+        """
+        Put batch from get_batch() that couldn't be delivered back at the
+        front of the queue, unless newer messages of its topics are queued.
+        """
+        queue = self._queue
+        if self.overflow == COALESCE:
+            for topic, payload in reversed(batch):
+                if topic not in queue:
+                    queue[topic] = payload
+                    queue.move_to_end(topic, last=False)
+        else:
+            queue.extendleft(reversed(batch))
+        if queue and self._waiter is not None:
+            if not self._waiter.done():
+                self._waiter.set_result(None)
+            self._waiter = None
+
+
+class Publisher:
+    """
+    Turns events of panels into messages and queues them for all
+    subscribers. Publishing costs a few dictionary operations per subscriber.
+    """
+    def __init__(self, loop, prefix=DEFAULT_PREFIX):
+        self.loop = loop
+        self.prefix = prefix
+        self.subscriptions = []
+        self.alarms = []
+        self._listeners = {}
+
+    def subscribe(self, name, maxsize=DEFAULT_QUEUE_SIZE, overflow=COALESCE):
+        """
+        Return new Subscription, starting with the current state of all
+        panels so that the subscriber doesn't have to wait for changes.
+        """
+        subscription = Subscription(self.loop, name, maxsize, overflow)
+        self.subscriptions.append(subscription)
+        self.resync(subscription)
+        return subscription
+
+    def resync(self, subscription):
+        """Queue the current state of all panels for subscription, e.g. after it lost messages."""
+        for alarm in self.alarms:
+            for topic, payload in self._state_messages(alarm):
+                subscription.put(topic, payload)
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.remove(subscription)
+
+    def add_alarm(self, alarm):
+        """Publish events of JablotronRS485 alarm."""
+        base = self._base(alarm)
+        listener = lambda event, id, value: self._on_event(base, event, id, value)
+        self._listeners[alarm] = listener
+        self.alarms.append(alarm)
+        alarm.add_event_listener(listener)
+        for topic, payload in self._state_messages(alarm):
+            self.publish(topic, payload)
+
+    def close(self):
+        for alarm in self.alarms:
+            alarm.remove_event_listener(self._listeners.pop(alarm))
+        self.alarms = []
+
+    def publish(self, topic, payload):
+        for subscription in self.subscriptions:
+            subscription.put(topic, payload)
+
+    def _on_event(self, base, event, id, value):
+        if event == EVENT_SENSOR:
+            self.publish('{}/sensor/{}'.format(base, id), 'ON' if value else 'OFF')
+        elif event == EVENT_SECTION:
+            self.publish('{}/section/{}'.format(base, id), value)
+        elif event == EVENT_FLAG:
+            flag, on = value
+            self.publish('{}/flag/{}/{}'.format(base, id, flag), 'ON' if on else 'OFF')
+        elif event == EVENT_ALARM:
+            self.publish('{}/state'.format(base), value)
+
+    def _base(self, alarm):
+        return self.prefix if alarm.id is None else '{}/{}'.format(self.prefix, alarm.id)
+
+    def _state_messages(self, alarm):
+        base = self._base(alarm)
+        yield '{}/state'.format(base), alarm.current_state
+        for section, state in sorted(alarm.section_states.items()):
+            yield '{}/section/{}'.format(base, section), state
+        for sensor in alarm.sensors.values():
+            yield '{}/sensor/{}'.format(base, sensor.id), 'ON' if sensor in alarm.active_sensors else 'OFF'
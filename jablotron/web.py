@@ -0,0 +1,166 @@
+#
+# Copyright (c) 2018-2020 Václav Slavík
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Minimal asyncio HTTP server for local endpoints of the bridge (metrics etc.).
+"""
+
+import asyncio
+import logging
+import urllib.parse
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS = '127.0.0.1'
+DEFAULT_PORT = 8585
+
+_reasons = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    409: 'Conflict',
+    500: 'Internal Server Error',
+}
+
+
+class Request:
+    def __init__(self, method, target, headers):
+        self.method = method
+        url = urllib.parse.urlsplit(target)
+        self.path = url.path
+        self.query = dict(urllib.parse.parse_qsl(url.query))
+        self.headers = headers
+
+
+class Response:
+    """
+    Response with body, or streamed from async iterator of bytes `stream`;
+    the connection is closed after a streamed response.
+    """
+    def __init__(self, body=b'', status=200, content_type='text/plain; charset=utf-8', headers=None, stream=None):
+        self.body = body
+        self.stream = stream
+        self.status = status
+        self.headers = {'Content-Type': content_type}
+        if headers:
+            self.headers.update(headers)
+
+
+class HTTPServer:
+    """
+    Serves GET requests by handlers registered with route(); a handler is a
+    coroutine function taking Request and returning Response.
+    """
+    def __init__(self):
+        self.routes = {}
+        self._server = None
+
+    def route(self, path, handler):
+        self.routes[path] = handler
+
+    async def start(self, address=DEFAULT_ADDRESS, port=DEFAULT_PORT):
+        self._server = await asyncio.start_server(self._handle_connection, address, port)
+        logger.info('HTTP server listening on %s:%d', address, port)
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                response = await self._respond(request)
+                self._write_response(writer, response, request.method != 'HEAD')
+                await writer.drain()
+                if response.stream is not None:
+                    if request.method != 'HEAD':
+                        await self._write_stream(writer, response.stream)
+                    break
+                if request.headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        method, target, _ = line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length:
+            await reader.readexactly(length)
+        return Request(method, target, headers)
+
+    async def _respond(self, request):
+        handler = self.routes.get(request.path)
+        if handler is None:
+            return Response(b'Not Found\n', status=404)
+        if request.method not in ('GET', 'HEAD'):
+            return Response(b'Method Not Allowed\n', status=405)
+        try:
+            return await handler(request)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('error handling %s', request.path)
+            return Response(b'Internal Server Error\n', status=500)
+
+    def _write_response(self, writer, response, with_body=True):
+        head = ['HTTP/1.1 {} {}'.format(response.status, _reasons.get(response.status, ''))]
+        head += ['{}: {}'.format(k, v) for k, v in response.headers.items()]
+        if response.stream is None:
+            head.append('Content-Length: {}'.format(len(response.body)))
+        else:
+            head.append('Connection: close')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        if with_body:
+            writer.write(response.body)
+
+    async def _write_stream(self, writer, stream):
+        try:
+            async for chunk in stream:
+                writer.write(chunk)
+                await writer.drain()
+        finally:
+            await stream.aclose()
+
+
+async def metrics_handler(request):
+    return Response(metrics.render().encode(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -21,25 +21,165 @@
 # SOFTWARE.
 #
 
+import jablotron.api
 import jablotron.core
+import jablotron.history
 import jablotron.homekit
+import jablotron.jlink
+import jablotron.logs
+import jablotron.mqtt
+import jablotron.profiling
+import jablotron.publisher
+import jablotron.web
 
 import asyncio
+import functools
 import logging
 import signal
+import time
+import toml
 
 
-logging.basicConfig(level=logging.INFO)
+CONFIG_FILE = 'jablotron.toml'
+
+# process-wide settings ([http], [mqtt] etc.) are read from the top level of
+# the file, panels may override only their own
+config = toml.load(CONFIG_FILE)
+panels = jablotron.core.load_config(CONFIG_FILE)
+
+
+def configure_logging(log_config):
+    logging.getLogger().setLevel(log_config.get('level', 'info').upper())
+    logging.getLogger(jablotron.logs.WIRE_LOGGER).setLevel(log_config.get('wire_level', 'info').upper())
+
+
+logging.basicConfig()
+configure_logging(config.get('logging', {}))
+log_listener = jablotron.logs.start_queue_logging()
 
 logger = logging.getLogger(__name__)
 logging.getLogger('pyhap.hap_server').setLevel(logging.WARNING)
 
 
-loop = asyncio.get_event_loop()
+# the serial links, HomeKit and everything else run on this one loop
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+
+for panel in panels:
+    if panel.get('jlink_export'):
+        for problem in jablotron.jlink.check_sensors(panel.get('sensors', []), panel['jlink_export']):
+            logger.warning('%s', problem)
+
+alarms = loop.run_until_complete(jablotron.core.create_connections(loop, panels))
+homekit = jablotron.homekit.create_driver(loop, alarms, config)
+
+history = None
+history_config = config.get('history')
+if history_config is not None:
+    history = jablotron.history.EventHistory(
+                    loop, history_config.get('file', 'jablotron.history'),
+                    capacity=history_config.get('capacity', jablotron.history.DEFAULT_CAPACITY),
+                    flush_interval=history_config.get('flush_interval', jablotron.history.DEFAULT_FLUSH_INTERVAL))
+    for alarm in alarms:
+        alarm.add_event_listener(functools.partial(history.record, panel=alarm.id or 0))
+
+mqtt_client = None
+mqtt_config = config.get('mqtt')
+if mqtt_config is not None:
+    publisher = jablotron.publisher.Publisher(loop, mqtt_config.get('prefix', jablotron.publisher.DEFAULT_PREFIX))
+    for alarm in alarms:
+        publisher.add_alarm(alarm)
+    subscription = publisher.subscribe('mqtt', mqtt_config.get('queue_size', jablotron.publisher.DEFAULT_QUEUE_SIZE),
+                                       mqtt_config.get('overflow', jablotron.publisher.COALESCE))
+    mqtt_client = jablotron.mqtt.MQTTClient(
+                    loop, subscription, mqtt_config['host'],
+                    port=mqtt_config.get('port', jablotron.mqtt.DEFAULT_PORT),
+                    client_id=mqtt_config.get('client_id', jablotron.mqtt.DEFAULT_CLIENT_ID),
+                    username=mqtt_config.get('username'),
+                    password=mqtt_config.get('password'),
+                    retain=mqtt_config.get('retain', True),
+                    status_topic='{}/status'.format(publisher.prefix),
+                    on_connect=functools.partial(publisher.resync, subscription))
+    mqtt_client.start()
+
+profiler = jablotron.profiling.Profiler(loop, alarms)
+profiler.install_signal_handlers()
+
+state_api = None
+http_server = None
+http_config = config.get('http')
+if http_config is not None:
+    http_server = jablotron.web.HTTPServer()
+    http_server.route('/metrics', jablotron.web.metrics_handler)
+    if http_config.get('api', False):
+        state_api = jablotron.api.StateAPI(loop, alarms)
+        state_api.register(http_server)
+    if http_config.get('debug', False):
+        profiler.register(http_server)
+    loop.run_until_complete(http_server.start(http_config.get('address', jablotron.web.DEFAULT_ADDRESS),
+                                              http_config.get('port', jablotron.web.DEFAULT_PORT)))
+
+
+def reload_config():
+    """Apply changes of the config file to the running bridge, keeping the serial links and HomeKit pairing."""
+    started = time.perf_counter()
+    changes = []
+    try:
+        new_config = toml.load(CONFIG_FILE)
+        new_panels = {p['id']: p for p in jablotron.core.load_config(CONFIG_FILE)}
+        if set(new_panels) != {alarm.id for alarm in alarms}:
+            raise ValueError('panels can be added or removed only after restart')
+        for alarm in alarms:
+            changes.append(alarm.reload(new_panels[alarm.id]))
+    except (OSError, KeyError, ValueError) as e:
+        logger.error('failed to reload %s: %s', CONFIG_FILE, e)
+    # panels reloaded before an error still need their accessories updated
+    jablotron.homekit.reload_driver(homekit, changes)
+    if state_api is not None:
+        state_api.invalidate()
+    if len(changes) == len(alarms):
+        configure_logging(new_config.get('logging', {}))
+        logger.info('reloaded %s in %.1f ms', CONFIG_FILE, (time.perf_counter() - started) * 1000)
+
+
+async def shutdown():
+    """Stop HomeKit, then everything else while the loop still runs, so that state and history get saved."""
+    try:
+        await homekit.async_stop()
+    except Exception:
+        logger.exception('failed to stop HomeKit driver')
+    if http_server is not None:
+        http_server.close()
+    if mqtt_client is not None:
+        await mqtt_client.close()
+    for alarm in alarms:
+        alarm.close()
+    if history is not None:
+        history.close()
+    # let the serial transports finish closing
+    await asyncio.sleep(0)
+    loop.stop()
+
+
+def request_shutdown():
+    logger.info('shutting down')
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.remove_signal_handler(signum)
+    loop.create_task(shutdown())
 
-alarm = loop.run_until_complete(jablotron.core.create_connection(loop, 'jablotron.toml'))
-homekit = jablotron.homekit.create_driver(loop, alarm)
 
-signal.signal(signal.SIGINT, homekit.signal_handler)
-signal.signal(signal.SIGTERM, homekit.signal_handler)
-homekit.start()
+loop.add_signal_handler(signal.SIGHUP, reload_config)
+loop.add_signal_handler(signal.SIGINT, request_shutdown)
+loop.add_signal_handler(signal.SIGTERM, request_shutdown)
+# the driver only stops loops it created itself, so the loop is run here
+homekit.add_job(homekit.async_start)
+try:
+    loop.run_forever()
+finally:
+    # let cancelled tasks (command queues, pollers etc.) finish
+    pending = asyncio.all_tasks(loop)
+    for task in pending:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+    loop.close()
+    log_listener.stop()
@@ -21,49 +21,48 @@
 # SOFTWARE.
 #
 
+"""
+Convert list of peripherals exported from J-Link to sensors configuration.
+
+    jlink2sensors.py jlink.xml                      print sensors array
+    jlink2sensors.py jlink.xml --merge jablotron.toml [--panel ID]
+                                                    update sensors in config
+"""
+
+import argparse
 import logging
 import sys
-import xml.etree.ElementTree as ET
 
-logger = logging.getLogger(__name__)
+from jablotron import jlink
 
+logger = logging.getLogger(__name__)
 
-def get_sensor_kind(model: str):
-    if model.endswith('M'):
-        return 'window'
-    if model.endswith('P'):
-        return 'motion'
-    if model.endswith('B'):
-        return 'glassbreak'
-    if model.endswith('A'):  # alarms/sirens
-        return 'ignore'
-    if model.endswith('E'):  # entry keypads
-        return 'ignore'
-    if model.endswith('R'):  # radio modules
-        return 'ignore'
-    if model == 'JA-121T':  # RS-485 interface
-        return 'ignore'
-    if (model.startswith('JA-100K') or model.startswith('JA-101K') or
-            model.startswith('JA-106K')):  # control panel
-        return 'ignore'
-    return None
 
+def main():
+    parser = argparse.ArgumentParser(description='Convert J-Link export of peripherals to sensors configuration.')
+    parser.add_argument('export', help='XML file exported from J-Link')
+    parser.add_argument('--merge', metavar='CONFIG',
+                        help='update sensors in this configuration file instead of printing them; '
+                             'names, kinds and other settings of existing sensors are kept')
+    parser.add_argument('--panel', type=int, help='update sensors of this panel of the configuration')
+    args = parser.parse_args()
 
-data = ET.parse(sys.argv[1])
-print('sensors = [')
-for row in data.findall('./table2/row'):
-    sid = int(row.find('position').text)
-    name = row.find('name').text
-    model = row.find('type').text
-    kind = get_sensor_kind(model)
-    if kind is None:
-        logger.warning('  # Warning: omitting sensor of unrecognized kind:')
-        print('  # {{ id = {:2}, model = "{}", name = "{}" }},'.format(sid, model, name))
-        continue
-    elif kind == 'ignore':
-        continue
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.merge:
+        result = jlink.merge_into_config(args.merge, args.export, args.panel)
+        for sid in result.added:
+            logger.info('added sensor #%d', sid)
+        for sid in result.updated:
+            logger.info('updated model or section of sensor #%d', sid)
+        for sid in result.removed:
+            logger.warning('sensor #%d is not in the export anymore, marked in the configuration', sid)
+        unrecognized = result.unrecognized
     else:
-        section = row.find('section').text
-        note = row.find('note').text
-        print('  {{ id = {:2}, model = "{}", kind = "{}", name = "{}" }},'.format(sid, model, kind, name))
-print(']')
+        sensors, unrecognized = jlink.sensors_from_export(args.export)
+        print(jlink.format_sensors(sensors, unrecognized=unrecognized))
+    for p in unrecognized:
+        logger.warning('sensor of unrecognized kind commented out: #%d %s "%s"', p.id, p.model, p.name)
+
+
+if __name__ == '__main__':
+    sys.exit(main())